@@ -1,6 +1,6 @@
 import sys
 
-from metalift.analysis_new import VariableTracker, analyze as analyze_new
+from metalift.analysis_new import VariableTracker
 from metalift.ir import *
 from metalift.smt_util import toSMT
 
@@ -10,6 +10,8 @@ from metalift.synthesize_cvc5 import generateAST, toExpr
 import typing
 from typing import Any
 
+from katara.analysis_cache import analyze as analyze_new
+
 
 def check_aci(filename: str, fnNameBase: str, loopsFile: str, cvcPath: str) -> None:
     """Check if the actor is commutative and idempotent.
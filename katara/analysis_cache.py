@@ -0,0 +1,55 @@
+import os
+import threading
+import typing
+
+from metalift.analysis_new import AnalysisResult, analyze as analyze_uncached
+
+from katara.result_cache import file_digest
+
+_AnalysisKey = typing.Tuple[str, str, str, str, str]
+
+_analyses: typing.Dict[_AnalysisKey, AnalysisResult] = {}
+_analysis_locks: typing.Dict[_AnalysisKey, threading.Lock] = {}
+_analyses_lock = threading.Lock()
+
+
+def _analysis_key(filename: str, fnName: str, loopsFile: str) -> _AnalysisKey:
+    return (
+        os.path.abspath(filename),
+        file_digest(filename),
+        fnName,
+        os.path.abspath(loopsFile),
+        file_digest(loopsFile) if os.path.exists(loopsFile) else "",
+    )
+
+
+def analyze(filename: str, fnName: str, loopsFile: str) -> AnalysisResult:
+    """`metalift.analysis_new.analyze`, memoized on the contents of the LLVM
+    and loops files.
+
+    The analysis of a function only depends on those files, so it is shared by
+    every candidate and every retry of a search. The result is only read when
+    generating VCs, each time with a fresh `VariableTracker`."""
+    key = _analysis_key(filename, fnName, loopsFile)
+    with _analyses_lock:
+        if key in _analyses:
+            return _analyses[key]
+        lock = _analysis_locks.setdefault(key, threading.Lock())
+
+    # analyze each function once, even if several candidates ask for it at once
+    with lock:
+        with _analyses_lock:
+            if key in _analyses:
+                return _analyses[key]
+
+        result = analyze_uncached(filename, fnName, loopsFile)
+        with _analyses_lock:
+            _analyses[key] = result
+        return result
+
+
+def warm(filename: str, fnNameBase: str, loopsFile: str) -> None:
+    """Analyze the functions of an actor ahead of time, so that worker
+    processes forked afterwards start with the analyses in memory."""
+    for suffix in ("_next_state", "_response", "_init_state"):
+        analyze(filename, fnNameBase + suffix, loopsFile)
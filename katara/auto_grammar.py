@@ -1,15 +1,31 @@
-from katara import lattices
+from katara import hash_cons, lattices
 from katara.lattices import Lattice
 from metalift.ir import *
 
+import collections
+import threading
 import typing
 from typing import Union, Dict
+import weakref
 from llvmlite.binding import ValueRef
 
 equality_supported_types = [Bool(), Int(), ClockInt(), EnumInt(), OpaqueInt()]
 comparison_supported_types = [Int(), ClockInt(), OpaqueInt()]
 
 
+class Commutative:
+    """An expansion whose two operands are drawn from the same pool and can be
+    swapped without changing its value."""
+
+    def __init__(
+        self, expansion: typing.Callable[[typing.Callable[[Type], Expr]], Expr]
+    ) -> None:
+        self.expansion = expansion
+
+    def __call__(self, get: typing.Callable[[Type], Expr]) -> Expr:
+        return self.expansion(get)
+
+
 def get_expansions(
     input_types: typing.List[Type],
     available_types: typing.List[Type],
@@ -22,11 +38,11 @@ def get_expansions(
         Bool(): [
             lambda get: BoolLit(False),
             lambda get: BoolLit(True),
-            lambda get: And(get(Bool()), get(Bool())),
-            lambda get: Or(get(Bool()), get(Bool())),
+            Commutative(lambda get: And(get(Bool()), get(Bool()))),
+            Commutative(lambda get: Or(get(Bool()), get(Bool()))),
             lambda get: Not(get(Bool())),
             *[
-                (lambda t: lambda get: Eq(get(t), get(t)))(t)
+                Commutative((lambda t: lambda get: Eq(get(t), get(t)))(t))
                 for t in equality_supported_types
             ],
             *[
@@ -43,11 +59,13 @@ def get_expansions(
     def gen_set_ops(t: Type) -> None:
         out[SetT(t)] = [
             lambda get: Call("set-minus", SetT(t), get(SetT(t)), get(SetT(t))),
-            lambda get: Call("set-union", SetT(t), get(SetT(t)), get(SetT(t))),
+            Commutative(
+                lambda get: Call("set-union", SetT(t), get(SetT(t)), get(SetT(t)))
+            ),
             lambda get: Call("set-insert", SetT(t), get(t), get(SetT(t))),
         ]
 
-        out[Bool()].append(lambda get: Eq(get(SetT(t)), get(SetT(t))))
+        out[Bool()].append(Commutative(lambda get: Eq(get(SetT(t)), get(SetT(t)))))
         out[Bool()].append(lambda get: Eq(get(SetT(t)), Call("set-create", SetT(t))))
         out[Bool()].append(
             lambda get: Call("set-subset", Bool(), get(SetT(t)), get(SetT(t)))
@@ -167,7 +185,7 @@ def get_expansions(
         out[Int()] += [
             lambda get: IntLit(0),
             lambda get: IntLit(1),
-            lambda get: Add(get(Int()), get(Int())),
+            Commutative(lambda get: Add(get(Int()), get(Int()))),
             lambda get: Sub(get(Int()), get(Int())),
         ]
 
@@ -220,25 +238,231 @@ def all_node_id_gets(
         return []
 
 
+def _reads(
+    expansion: typing.Callable[[typing.Callable[[Type], Expr]], Expr]
+) -> typing.Optional[typing.Set[Type]]:
+    """The types of the pools `expansion` builds on, or `None` if it cannot be
+    probed."""
+    read: typing.Set[Type] = set()
+
+    def get(t: Type) -> Expr:
+        read.add(t)
+        return Var("probe", t)
+
+    try:
+        expansion(get)
+    except Exception:
+        return None
+    return read
+
+
+def distances_to(
+    out_type: Type,
+    expansions: Dict[
+        Type, typing.List[typing.Callable[[typing.Callable[[Type], Expr]], Expr]]
+    ],
+    enable_ite: bool,
+) -> typing.Optional[Dict[Type, int]]:
+    """The smallest number of expansions through which an expression of each
+    type can become part of an expression of `out_type`. Types that are
+    missing cannot become part of one at all. Returns `None` if some of the
+    expansions cannot be analyzed."""
+    sources: Dict[Type, typing.Set[Type]] = {}
+    for t, expansion_list in expansions.items():
+        for expansion in expansion_list:
+            read = _reads(expansion)
+            if read is None:
+                return None
+            sources.setdefault(t, set()).update(read)
+
+    if enable_ite:
+        for t in set(sources.keys()).union(*sources.values()) | {out_type}:
+            if t.name != "Set" and t.name != "Map":
+                sources.setdefault(t, set()).add(Bool())
+
+    distances = {out_type: 0}
+    frontier = [out_type]
+    while frontier:
+        next_frontier = []
+        for t in frontier:
+            for source in sources.get(t, set()):
+                if source not in distances:
+                    distances[source] = distances[t] + 1
+                    next_frontier.append(source)
+        frontier = next_frontier
+    return distances
+
+
+class _Identity:
+    """Compares and hashes a canonical expression by identity."""
+
+    def __init__(self, e: Expr) -> None:
+        self.e = e
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, _Identity) and self.e is other.e
+
+    def __hash__(self) -> int:
+        return id(self.e)
+
+
+_GrammarKey = typing.Tuple[
+    typing.Optional[Type], int, bool, bool, bool, typing.Tuple[_Identity, ...]
+]
+
+# grammars are rebuilt for every candidate and retry from the same inputs
+_grammars: "weakref.WeakValueDictionary[_GrammarKey, Expr]" = (
+    weakref.WeakValueDictionary()
+)
+_grammars_lock = threading.Lock()
+
+_SkeletonKey = typing.Tuple[Type, int, bool, bool, bool, typing.Tuple[Type, ...]]
+
+# grammars over placeholder inputs, by the types of the inputs, with the least
+# recently used evicted so that long searches over many structures do not keep
+# the skeletons of every structure they have enumerated
+_skeletons: "collections.OrderedDict[_SkeletonKey, typing.Tuple[Expr, typing.Tuple[Expr, ...]]]" = (
+    collections.OrderedDict()
+)
+_skeletons_lock = threading.Lock()
+SKELETON_CACHE_SIZE = 256
+
+
+def _skeleton(
+    out_type: Type,
+    depth: int,
+    input_types: typing.Tuple[Type, ...],
+    enable_ite: bool,
+    allow_node_id_reductions: bool,
+    break_symmetries: bool,
+) -> typing.Tuple[Expr, typing.Tuple[Expr, ...]]:
+    key = (
+        out_type,
+        depth,
+        enable_ite,
+        allow_node_id_reductions,
+        break_symmetries,
+        input_types,
+    )
+    with _skeletons_lock:
+        cached = _skeletons.get(key)
+        if cached is not None:
+            _skeletons.move_to_end(key)
+    if cached is None:
+        placeholders = tuple(
+            hash_cons.intern(Var(f"grammar_input_{i}", t))
+            for i, t in enumerate(input_types)
+        )
+        cached = (
+            _auto_grammar(
+                out_type,
+                depth,
+                *placeholders,
+                enable_ite=enable_ite,
+                allow_node_id_reductions=allow_node_id_reductions,
+                break_symmetries=break_symmetries,
+            ),
+            placeholders,
+        )
+        with _skeletons_lock:
+            cached = _skeletons.setdefault(key, cached)
+            _skeletons.move_to_end(key)
+            while len(_skeletons) > SKELETON_CACHE_SIZE:
+                _skeletons.popitem(last=False)
+    return cached
+
+
 def auto_grammar(
     out_type: typing.Optional[Type],
     depth: int,
     *inputs: Union[Expr, ValueRef],
     enable_ite: bool = False,
     allow_node_id_reductions: bool = False,
+    break_symmetries: bool = True,
+) -> Expr:
+    """A grammar of expressions of `out_type` up to `depth` deep over
+    `inputs`, or the grammars of all types if `out_type` is `None`.
+
+    Grammars are built out of hash-consed expressions, so that the subtrees
+    shared between depths and between grammars are single objects, and
+    grammars for the same inputs are only built once while they are alive.
+    The grammars for inputs of the same types are built over placeholder
+    inputs that are then substituted with `inputs`, and the most recently
+    used `SKELETON_CACHE_SIZE` of them are kept.
+
+    With `break_symmetries`, commutative operators such as `And`, `Eq`, `Add`
+    and `set-union` take their first operand only from the expressions that
+    are new at the previous depth, so that each pair of operands is only
+    offered in one order and the pairs already offered at the previous depth
+    are not offered again. This describes the same expressions up to the
+    order of operands."""
+    if all(isinstance(input, Expr) for input in inputs):
+        inputs = tuple(hash_cons.intern(input) for input in inputs)
+        if out_type is not None:
+            key = (
+                out_type,
+                depth,
+                enable_ite,
+                allow_node_id_reductions,
+                break_symmetries,
+                tuple(_Identity(input) for input in inputs),
+            )
+            with _grammars_lock:
+                cached = _grammars.get(key)
+            if cached is not None:
+                return cached
+            skeleton, placeholders = _skeleton(
+                out_type,
+                depth,
+                tuple(parseTypeRef(input.type) for input in inputs),
+                enable_ite,
+                allow_node_id_reductions,
+                break_symmetries,
+            )
+            out = hash_cons.substitute(
+                skeleton,
+                {
+                    id(placeholder): input
+                    for placeholder, input in zip(placeholders, inputs)
+                },
+            )
+            with _grammars_lock:
+                _grammars[key] = out
+            return out
+
+    return _auto_grammar(
+        out_type,
+        depth,
+        *inputs,
+        enable_ite=enable_ite,
+        allow_node_id_reductions=allow_node_id_reductions,
+        break_symmetries=break_symmetries,
+    )
+
+
+def _auto_grammar(
+    out_type: typing.Optional[Type],
+    depth: int,
+    *inputs: Union[Expr, ValueRef],
+    enable_ite: bool = False,
+    allow_node_id_reductions: bool = False,
+    break_symmetries: bool = True,
 ) -> Expr:
     if out_type and out_type.name == "Tuple":
-        return Tuple(
-            *[
-                auto_grammar(
-                    t,
-                    depth,
-                    *inputs,
-                    enable_ite=enable_ite,
-                    allow_node_id_reductions=allow_node_id_reductions,
-                )
-                for t in out_type.args
-            ]
+        return hash_cons.intern(
+            Tuple(
+                *[
+                    auto_grammar(
+                        t,
+                        depth,
+                        *inputs,
+                        enable_ite=enable_ite,
+                        allow_node_id_reductions=allow_node_id_reductions,
+                        break_symmetries=break_symmetries,
+                    )
+                    for t in out_type.args
+                ]
+            )
         )
 
     input_pool: Dict[Type, typing.List[Expr]] = {}
@@ -247,7 +471,9 @@ def auto_grammar(
         if input_type.name == "Tuple":
             for i, t in enumerate(input_type.args):
                 if input != None:
-                    extract_inputs(t, TupleGet(input, IntLit(i)))  # type: ignore
+                    extract_inputs(
+                        t, hash_cons.intern(TupleGet(input, IntLit(i)))  # type: ignore
+                    )
                 else:
                     extract_inputs(t, None)
         else:
@@ -276,8 +502,17 @@ def auto_grammar(
         input_types, list(input_pool.keys()), out_types, allow_node_id_reductions
     )
 
+    distances = distances_to(out_type, expansions, enable_ite) if out_type else None
+
+    def contributes(t: Type, remaining: int) -> bool:
+        """Whether the pool of `t` can still flow into the grammar of
+        `out_type` with `remaining` expansions left."""
+        return distances is None or distances.get(t, remaining + 1) <= remaining
+
     pool: Dict[Type, Expr] = {}
     for t, exprs in input_pool.items():
+        if not contributes(t, depth):
+            continue
         zero_input_expansions = []
         if t in expansions:
             for e in expansions[t]:
@@ -286,15 +521,40 @@ def auto_grammar(
                 except KeyError:
                     pass
         if (len(exprs) + len(zero_input_expansions)) > 0:
-            pool[t] = Choose(*exprs, *zero_input_expansions)
+            pool[t] = hash_cons.intern(Choose(*exprs, *zero_input_expansions))
+
+    # the expressions that are new at the current depth, by type
+    fresh = dict(pool)
+
+    def fresh_first() -> typing.Callable[[Type], Expr]:
+        drawn: typing.Set[Type] = set()
+
+        def get(t: Type) -> Expr:
+            if t in drawn:
+                return pool[t]
+            drawn.add(t)
+            return fresh[t]
+
+        return get
 
     for i in range(depth):
-        next_pool = dict(pool)
+        remaining = depth - i - 1
+        next_pool = {t: e for t, e in pool.items() if contributes(t, remaining)}
+        next_fresh: Dict[Type, typing.List[Expr]] = {}
         for t, expansion_list in expansions.items():
+            if not contributes(t, remaining):
+                continue
             new_elements = []
             for expansion in expansion_list:
                 try:
-                    new_elements.append(expansion(lambda t: pool[t]))
+                    # the children come from the pool, so interning is cheap
+                    if break_symmetries and isinstance(expansion, Commutative):
+                        # pairs of older operands were offered at the last depth
+                        new_elements.append(hash_cons.intern(expansion(fresh_first())))
+                    else:
+                        new_elements.append(
+                            hash_cons.intern(expansion(lambda t: pool[t]))
+                        )
                 except KeyError:
                     pass
 
@@ -303,23 +563,27 @@ def auto_grammar(
                 and isinstance(next_pool[t], Expr)
                 and isinstance(next_pool[t], Choose)
             ):
-                existing_set = set(next_pool[t].args)
-                new_elements = [e for e in new_elements if e not in existing_set]
+                existing_ids = {id(e) for e in next_pool[t].args}
+                new_elements = [e for e in new_elements if id(e) not in existing_ids]
 
             if len(new_elements) > 0:
+                next_fresh[t] = new_elements
                 if t in pool:
-                    next_pool[t] = Choose(next_pool[t], *new_elements)
+                    next_pool[t] = hash_cons.intern(Choose(next_pool[t], *new_elements))
                 else:
-                    next_pool[t] = Choose(*new_elements)
+                    next_pool[t] = hash_cons.intern(Choose(*new_elements))
 
         if enable_ite and Bool() in pool:
             for t in pool.keys():
-                if t.name != "Set" and t.name != "Map":
-                    next_pool[t] = Choose(
-                        next_pool[t], Ite(pool[Bool()], pool[t], pool[t])
-                    )
+                if t in next_pool and t.name != "Set" and t.name != "Map":
+                    ite = hash_cons.intern(Ite(pool[Bool()], pool[t], pool[t]))
+                    next_pool[t] = hash_cons.intern(Choose(next_pool[t], ite))
+                    next_fresh.setdefault(t, []).append(ite)
 
         pool = next_pool
+        fresh = {
+            t: hash_cons.intern(Choose(*elements)) for t, elements in next_fresh.items()
+        }
 
     if out_type:
         return pool[out_type]
@@ -355,9 +619,10 @@ def expand_lattice_logic(*inputs: typing.Tuple[Expr, Lattice]) -> typing.List[Ex
                     lattice.valueType.bottom(),
                 )
 
+                value_max = hash_cons.intern(value_max)
                 if lattice.valueType not in next_pool:
                     next_pool[lattice.valueType] = []
-                if value_max not in next_pool[lattice.valueType]:
+                if all(e is not value_max for e in next_pool[lattice.valueType]):
                     next_pool[lattice.valueType].append(value_max)
 
     lattice_to_exprs = next_pool
@@ -0,0 +1,238 @@
+import contextlib
+import os
+import signal
+import subprocess
+import threading
+from time import sleep, time
+import typing
+
+from metalift import process_tracker
+
+
+def _children() -> typing.Dict[int, typing.List[int]]:
+    children: typing.Dict[int, typing.List[int]] = {}
+    if not os.path.isdir("/proc"):
+        return children
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # the command name may contain spaces, the ppid follows it
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    return children
+
+
+def process_tree(pid: int) -> typing.List[int]:
+    """The pid and the pids of all its descendants (Linux only, other platforms
+    only report the process itself)."""
+    children = _children()
+    tree = [pid]
+    i = 0
+    while i < len(tree):
+        tree += children.get(tree[i], [])
+        i += 1
+    return tree
+
+
+def rss_bytes(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+class CandidateBudget(typing.NamedTuple):
+    """Wall-clock (seconds) and solver memory (bytes) limits for a candidate.
+
+    Limits are multiplied by `depthGrowth` for every base depth above 1, so
+    that deeper grammars get proportionally more room."""
+
+    timeLimit: typing.Optional[float] = None
+    memoryLimit: typing.Optional[int] = None
+    depthGrowth: float = 1.0
+
+    def for_depth(
+        self, baseDepth: int
+    ) -> typing.Tuple[typing.Optional[float], typing.Optional[int]]:
+        scale = self.depthGrowth ** max(baseDepth - 1, 0)
+        return (
+            self.timeLimit * scale if self.timeLimit is not None else None,
+            int(self.memoryLimit * scale) if self.memoryLimit is not None else None,
+        )
+
+
+class CandidateScope:
+    """The solver processes spawned while synthesizing a single candidate.
+
+    Processes registered with `process_tracker` while the scope is active on
+    the current thread are attributed to it, so that they can be measured and
+    cancelled independently of the processes of other candidates."""
+
+    def __init__(
+        self,
+        uid: int,
+        timeLimit: typing.Optional[float] = None,
+        memoryLimit: typing.Optional[int] = None,
+        parent: typing.Optional["CandidateScope"] = None,
+    ) -> None:
+        self.uid = uid
+        self.parent = parent
+        self.children: typing.List["CandidateScope"] = []
+        self.timeLimit = timeLimit
+        self.memoryLimit = memoryLimit
+        self.start = time()
+        self.processes: typing.List["subprocess.Popen[bytes]"] = []
+        self.cancelled: typing.Optional[str] = None
+        # the number of times synthesis was retried, by reason
+        self.retries: typing.Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def child(self) -> "CandidateScope":
+        """A scope for part of the work on this candidate, which can be
+        cancelled on its own. Its processes also count towards this scope, and
+        cancelling this scope cancels it."""
+        child = CandidateScope(self.uid, parent=self)
+        with self.lock:
+            self.children.append(child)
+            cancelled = self.cancelled
+        if cancelled is not None:
+            child.cancel(cancelled)
+        return child
+
+    def add_process(self, p: "subprocess.Popen[bytes]") -> None:
+        with self.lock:
+            self.processes.append(p)
+            cancelled = self.cancelled is not None
+        if cancelled:
+            _terminate_tree(p)
+        if self.parent is not None:
+            self.parent.add_process(p)
+
+    def count_retry(self, reason: str) -> None:
+        with self.lock:
+            self.retries[reason] = self.retries.get(reason, 0) + 1
+        if self.parent is not None:
+            self.parent.count_retry(reason)
+
+    def rss(self) -> int:
+        with self.lock:
+            processes = list(self.processes)
+        return sum(
+            rss_bytes(pid)
+            for p in processes
+            if p.poll() is None
+            for pid in process_tree(p.pid)
+        )
+
+    def cancel(self, reason: str) -> None:
+        with self.lock:
+            if self.cancelled is None:
+                self.cancelled = reason
+            processes = list(self.processes)
+            children = list(self.children)
+        for child in children:
+            child.cancel(reason)
+        for p in processes:
+            _terminate_tree(p)
+
+    def check_budget(self) -> None:
+        if self.cancelled is not None:
+            return
+        if self.timeLimit is not None and time() - self.start > self.timeLimit:
+            self.cancel("timeout")
+        elif self.memoryLimit is not None and self.rss() > self.memoryLimit:
+            self.cancel("oom")
+
+
+def _terminate_tree(p: "subprocess.Popen[bytes]") -> None:
+    if p.poll() is not None:
+        return
+    for pid in reversed(process_tree(p.pid)[1:]):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+    p.terminate()
+
+
+_current = threading.local()
+_active_scopes: typing.Set[CandidateScope] = set()
+_active_scopes_lock = threading.Lock()
+_watchdog: typing.Optional[threading.Thread] = None
+
+
+def current_scope() -> typing.Optional[CandidateScope]:
+    return typing.cast(
+        typing.Optional[CandidateScope], getattr(_current, "scope", None)
+    )
+
+
+def active_scopes() -> typing.List[CandidateScope]:
+    with _active_scopes_lock:
+        return list(_active_scopes)
+
+
+def _watch_budgets(interval: float) -> None:
+    while True:
+        sleep(interval)
+        for scope in active_scopes():
+            scope.check_budget()
+
+
+class _ScopedProcessList(list):  # type: ignore
+    def append(self, p: typing.Any) -> None:
+        super().append(p)
+        scope = current_scope()
+        if scope is not None:
+            scope.add_process(p)
+
+    def extend(self, processes: typing.Iterable[typing.Any]) -> None:
+        for p in processes:
+            self.append(p)
+
+    def __iadd__(  # type: ignore[misc]
+        self, processes: typing.Iterable[typing.Any]
+    ) -> "_ScopedProcessList":
+        self.extend(processes)
+        return self
+
+
+def install() -> None:
+    """Attribute processes registered with `process_tracker` to the scope
+    active on the registering thread."""
+    if not isinstance(process_tracker.all_processes, _ScopedProcessList):
+        process_tracker.all_processes = _ScopedProcessList(
+            process_tracker.all_processes
+        )
+
+
+@contextlib.contextmanager
+def candidate_scope(scope: CandidateScope) -> typing.Iterator[CandidateScope]:
+    global _watchdog
+
+    install()
+    previous = current_scope()
+    _current.scope = scope
+    with _active_scopes_lock:
+        _active_scopes.add(scope)
+        if _watchdog is None and (
+            scope.timeLimit is not None or scope.memoryLimit is not None
+        ):
+            _watchdog = threading.Thread(
+                target=_watch_budgets, args=(1.0,), daemon=True
+            )
+            _watchdog.start()
+    try:
+        yield scope
+    finally:
+        with _active_scopes_lock:
+            _active_scopes.discard(scope)
+        _current.scope = previous
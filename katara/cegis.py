@@ -0,0 +1,269 @@
+import glob
+import hashlib
+import os
+import pickle
+import re
+import subprocess
+import tempfile
+import typing
+
+from metalift import process_tracker
+from metalift.ir import And, Axiom, Expr, FnDecl, FnDeclNonRecursive, Lambda, Var
+from metalift.smt_util import toSMT
+from metalift.synthesis_common import VerificationFailed
+
+from katara.aci import lookup_var
+from katara.result_cache import file_digest
+
+
+class CounterexampleFound(VerificationFailed):
+    """A synthesized design failed to verify, with the values of the VC
+    variables in the counterexample that could be read back from CVC5 (which
+    may be none of them). `replayed` is set if the counterexample was found
+    by replaying those of other candidates."""
+
+    def __init__(
+        self, assignment: typing.Dict[str, Expr], replayed: bool = False
+    ) -> None:
+        super().__init__("CVC5 found a counterexample to the synthesized design")
+        self.assignment = assignment
+        self.replayed = replayed
+
+
+def verification_query(basename: str, uid: int, since: float) -> typing.Optional[str]:
+    """The SMT query metalift wrote to `synthesisLogs` when verifying the
+    design of candidate `uid` (possibly under a racing backend's `_r<i>`
+    suffix), or `None` if there is none written after `since`."""
+    pattern = re.compile(re.escape(basename) + r"(_r\d+)?(_" + str(uid) + r")?\.smt")
+    queries = []
+    for path in glob.glob(
+        os.path.join("synthesisLogs", glob.escape(basename) + "*.smt")
+    ):
+        try:
+            mtime = os.path.getmtime(path)
+        except FileNotFoundError:
+            continue
+        if pattern.fullmatch(os.path.basename(path)) and mtime >= since:
+            queries.append((mtime, path))
+    return max(queries)[1] if queries else None
+
+
+def _solve(
+    smtFile: str, inputs: typing.Set[Var], cvcPath: str, timeLimit: int
+) -> typing.Tuple[str, typing.Optional[typing.Dict[str, Expr]]]:
+    proc = subprocess.Popen(
+        [cvcPath, "--lang=smt", "--produce-models", f"--tlimit={timeLimit}", smtFile],
+        stdout=subprocess.PIPE,
+    )
+    # lets the candidate scope cancel the check
+    process_tracker.all_processes.append(proc)
+    stdout, _ = proc.communicate()
+    resultVerify = stdout.decode("utf-8").split("\n")
+    if resultVerify[0] != "sat":
+        return resultVerify[0], None
+
+    assignment = {}
+    for v in sorted(inputs, key=lambda v: v.name()):
+        try:
+            assignment[v.name()] = lookup_var(v, resultVerify)
+        except Exception:
+            pass
+    return resultVerify[0], assignment
+
+
+def find_counterexample(
+    smtFile: str,
+    vars: typing.Set[Var],
+    cvcPath: str,
+    timeLimit: int = 100000,
+) -> typing.Optional[typing.Dict[str, Expr]]:
+    """Solve the verification query `smtFile` written by metalift again with
+    CVC5, asking for a model, within `timeLimit` milliseconds.
+
+    Returns the values of `vars` in the counterexample, by variable name, if
+    CVC5 finds one, and `None` if it does not (the design verifies, or CVC5
+    gives up, times out, fails or is killed). Values CVC5 does not produce or
+    that cannot be translated back to the IR are left out."""
+    return _solve(smtFile, vars, cvcPath, timeLimit)[1]
+
+
+def uses_function_arguments(exprs: typing.Iterable[Expr]) -> bool:
+    """Whether any of `exprs` passes a function as an argument.
+
+    metalift specializes the functions taking function arguments for every
+    call site when it builds a verification query, so only queries that do
+    not need this can be built with `check_design`."""
+    seen: typing.Set[int] = set()
+    stack: typing.List[typing.Any] = list(exprs)
+    while stack:
+        e = stack.pop()
+        # grammars share subexpressions, visit each once
+        if id(e) in seen:
+            continue
+        seen.add(id(e))
+        if isinstance(e, Lambda):
+            return True
+        elif isinstance(e, Expr):
+            stack.extend(e.args)
+        elif isinstance(e, (list, tuple)):
+            stack.extend(e)
+    return False
+
+
+def check_design(
+    smtFile: str,
+    targetLang: typing.List[typing.Union[FnDecl, FnDeclNonRecursive, Axiom]],
+    candidates: typing.List[FnDecl],
+    vars: typing.Set[Var],
+    inputs: typing.Set[Var],
+    vc: Expr,
+    cvcPath: str,
+    timeLimit: int = 100000,
+) -> typing.Tuple[str, typing.Optional[typing.Dict[str, Expr]]]:
+    """Verify `candidates` against `vc` with CVC5 within `timeLimit`
+    milliseconds, with the query metalift builds for designs that pass no
+    functions as arguments (see `uses_function_arguments`).
+
+    Returns the result of CVC5, and on "sat" the values of `inputs` in the
+    counterexample as `find_counterexample` does."""
+    os.makedirs("synthesisLogs", exist_ok=True)
+    toSMT(targetLang, vars, candidates, [], vc, smtFile, [], [])
+    return _solve(smtFile, inputs, cvcPath, timeLimit)
+
+
+def instantiate(
+    vc: Expr, assignment: typing.Dict[str, Expr], inputs: typing.Set[Var]
+) -> Expr:
+    """`vc` with the values `assignment` gives to `inputs` substituted.
+
+    Only the universally quantified inputs of the VC should be given. The VC
+    also has variables it equates with the results of synthesized functions,
+    such as the synthesized state after an operation. Their values in a
+    counterexample come from the rejected design, and fixing them would make
+    the instance hold trivially for any other design, so they stay free."""
+    names = {v.name() for v in inputs}
+    return vc.rewrite(
+        {name: value for name, value in assignment.items() if name in names}
+    )
+
+
+class CounterexampleBank:
+    """Counterexamples found while verifying the candidates of a search,
+    replayed against the designs of later candidates before verifying them in
+    full.
+
+    Only the values of variables that do not belong to the synthesized state
+    are kept, such as the sequential start state and the operation and query
+    arguments, so that they apply to any lattice structure for the same
+    sequential program. Entries are stored in `directory` like those of a
+    `ResultCache`, so that they are shared by worker processes and concurrent
+    searches, and up to `replayLimit` of the most recent ones are replayed.
+
+    With `seed`, the VCs of later candidates must also hold on the
+    `seedLimit` most recent entries when synthesizing. This steers Rosette
+    away from designs that are known to fail, but makes every synthesis query
+    larger, so it is off by default."""
+
+    def __init__(
+        self,
+        directory: str,
+        replayLimit: int = 32,
+        seed: bool = False,
+        seedLimit: int = 8,
+    ) -> None:
+        self.directory = directory
+        self.replayLimit = replayLimit
+        self.seed = seed
+        self.seedLimit = seedLimit
+
+    def problem_key(self, filename: str, fnNameBase: str, vars: typing.Set[Var]) -> str:
+        h = hashlib.sha256()
+        h.update(file_digest(filename).encode("utf-8"))
+        h.update(fnNameBase.encode("utf-8"))
+        for v in sorted(vars, key=lambda v: v.name()):
+            if not v.name().startswith("synth_"):
+                h.update(f"{v.name()}:{v.type!r}".encode("utf-8"))
+        return h.hexdigest()
+
+    def _dir(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def add(self, key: str, assignment: typing.Dict[str, Expr]) -> None:
+        shared = {
+            name: value
+            for name, value in assignment.items()
+            if not name.startswith("synth_")
+        }
+        if not shared:
+            return
+        data = pickle.dumps(shared)
+        directory = self._dir(key)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        # identical counterexamples share an entry
+        os.replace(
+            tmp_path,
+            os.path.join(directory, hashlib.sha256(data).hexdigest() + ".pickle"),
+        )
+
+    def entries(self, key: str, limit: int) -> typing.List[typing.Dict[str, Expr]]:
+        directory = self._dir(key)
+        try:
+            paths = [
+                os.path.join(directory, name)
+                for name in os.listdir(directory)
+                if name.endswith(".pickle")
+            ]
+        except FileNotFoundError:
+            return []
+
+        def mtime(path: str) -> float:
+            try:
+                return os.path.getmtime(path)
+            except FileNotFoundError:
+                return 0.0
+
+        entries = []
+        for path in sorted(paths, key=mtime, reverse=True)[:limit]:
+            try:
+                with open(path, "rb") as f:
+                    entries.append(typing.cast(typing.Dict[str, Expr], pickle.load(f)))
+            except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+                pass
+        return entries
+
+    def replay(
+        self,
+        key: str,
+        basename: str,
+        uid: int,
+        targetLang: typing.List[typing.Union[FnDecl, FnDeclNonRecursive, Axiom]],
+        candidates: typing.List[FnDecl],
+        vars: typing.Set[Var],
+        inputs: typing.Set[Var],
+        vc: Expr,
+        cvcPath: str,
+        timeLimit: int = 100000,
+    ) -> typing.Optional[typing.Dict[str, Expr]]:
+        """Check `candidates` against `vc` on the banked counterexamples only,
+        which is much cheaper than verifying them in full. Returns a
+        counterexample if one of them applies, and otherwise `None`. The same
+        restrictions as for `check_design` apply."""
+        instances = [
+            instantiate(vc, entry, inputs)
+            for entry in self.entries(key, self.replayLimit)
+        ]
+        if not instances:
+            return None
+        return check_design(
+            f"synthesisLogs/replay_{basename}_{uid}.smt",
+            targetLang,
+            candidates,
+            vars,
+            inputs,
+            instances[0] if len(instances) == 1 else And(*instances),
+            cvcPath,
+            timeLimit,
+        )[1]
@@ -0,0 +1,110 @@
+import multiprocessing as mp
+import os
+from time import time
+import typing
+
+from katara.candidate_scope import process_tree, rss_bytes
+
+
+def available_memory() -> typing.Optional[int]:
+    """Memory available for new processes in bytes, if known (Linux only)."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def descendants_rss() -> int:
+    return sum(rss_bytes(pid) for pid in process_tree(os.getpid())[1:])
+
+
+class ConcurrencyController:
+    """Adapts the number of candidates synthesized at once to the load of the
+    host, between `floor` and `ceiling`.
+
+    Every `interval` seconds, the limit shrinks by one if the load average per
+    core is above `highLoad` or less than `memoryReserve` bytes of memory are
+    available. It grows by one if all slots are busy, the load per core is
+    below `lowLoad` and the available memory fits another candidate, as
+    estimated from the memory used by the candidates in flight. Candidates in
+    flight are never cancelled, a shrunk limit takes effect as they finish."""
+
+    def __init__(
+        self,
+        floor: int = 1,
+        ceiling: int = mp.cpu_count(),
+        initial: typing.Optional[int] = None,
+        interval: float = 30.0,
+        lowLoad: float = 0.7,
+        highLoad: float = 1.0,
+        memoryReserve: int = 1024 * 1024 * 1024,
+    ) -> None:
+        if not 1 <= floor <= ceiling:
+            raise ValueError(f"invalid concurrency bounds {floor}..{ceiling}")
+        self.floor = floor
+        self.ceiling = ceiling
+        self.current = min(max(initial or floor, floor), ceiling)
+        self.interval = interval
+        self.lowLoad = lowLoad
+        self.highLoad = highLoad
+        self.memoryReserve = memoryReserve
+        self.last_decision: typing.Optional[float] = None
+        self.candidate_rss: typing.Optional[int] = None
+
+    def limit(self, inFlight: int) -> int:
+        now = time()
+        if self.last_decision is not None and now - self.last_decision < self.interval:
+            return self.current
+        self.last_decision = now
+
+        load = os.getloadavg()[0] / mp.cpu_count()
+        available = available_memory()
+        if inFlight > 0:
+            self.candidate_rss = descendants_rss() // inFlight
+
+        previous = self.current
+        if available is not None and available < self.memoryReserve:
+            reason = "memory is low"
+            self.current = max(self.current - 1, self.floor)
+        elif load > self.highLoad:
+            reason = "load is high"
+            self.current = max(self.current - 1, self.floor)
+        elif inFlight < self.current:
+            reason = "slots are free"
+        elif load >= self.lowLoad:
+            reason = "load is moderate"
+        elif (
+            available is not None
+            and self.candidate_rss is not None
+            and available - self.memoryReserve < self.candidate_rss
+        ):
+            reason = "another candidate would not fit in memory"
+        else:
+            reason = "load is low"
+            self.current = min(self.current + 1, self.ceiling)
+
+        action = (
+            "growing"
+            if self.current > previous
+            else "shrinking"
+            if self.current < previous
+            else "keeping"
+        )
+        memory = (
+            f"{available // (1024 * 1024)} MB available"
+            if available is not None
+            else "available memory unknown"
+        )
+        candidate_memory = (
+            f"{self.candidate_rss // (1024 * 1024)} MB per candidate"
+            if self.candidate_rss is not None
+            else "memory per candidate unknown"
+        )
+        print(
+            f"Concurrency: {action} limit {previous} -> {self.current} since {reason} (load {load:.2f} per core, {memory}, {candidate_memory}, {inFlight} in flight)"
+        )
+        return self.current
@@ -0,0 +1,109 @@
+import copy
+import threading
+import typing
+import weakref
+
+from metalift.ir import Expr
+
+_Key = typing.Tuple[typing.Any, ...]
+
+# the canonical expressions, keyed by their constructor, type and the ids of
+# their (canonical) children, which stay valid while the expression is alive
+_table: "weakref.WeakValueDictionary[_Key, Expr]" = weakref.WeakValueDictionary()
+# ids of the canonical expressions
+_canonical: typing.Dict[int, "weakref.ref[Expr]"] = {}
+_lock = threading.RLock()
+
+
+def is_canonical(e: Expr) -> bool:
+    ref = _canonical.get(id(e))
+    return ref is not None and ref() is e
+
+
+def _forget(id: int) -> typing.Callable[["weakref.ref[Expr]"], None]:
+    def forget(_: "weakref.ref[Expr]") -> None:
+        _canonical.pop(id, None)
+
+    return forget
+
+
+def _intern(e: Expr, seen: typing.Dict[int, Expr]) -> Expr:
+    if is_canonical(e):
+        return e
+    elif id(e) in seen:
+        return seen[id(e)]
+
+    args = [_intern(a, seen) if isinstance(a, Expr) else a for a in e.args]
+    key = (
+        type(e),
+        e.type,
+        *[id(a) if isinstance(a, Expr) else (type(a), a) for a in args],
+    )
+    try:
+        canonical = _table.get(key)
+    except TypeError:
+        # an argument that is not an expression cannot be hashed
+        seen[id(e)] = e
+        return e
+
+    if canonical is None:
+        if any(new is not old for new, old in zip(args, e.args)):
+            canonical = copy.copy(e)
+            canonical.args = args
+        else:
+            canonical = e
+        _table[key] = canonical
+        _canonical[id(canonical)] = weakref.ref(canonical, _forget(id(canonical)))
+
+    seen[id(e)] = canonical
+    return canonical
+
+
+def intern(e: Expr) -> Expr:
+    """The canonical expression structurally equal to `e`.
+
+    Canonical expressions are shared, so two of them are equal exactly when
+    they are the same object, and can be deduplicated by `id` instead of by
+    hashing and comparing whole subtrees. Building an expression out of
+    canonical children and interning it only looks at its direct children.
+    Canonical expressions must not be mutated."""
+    with _lock:
+        return _intern(e, {})
+
+
+def unique(exprs: typing.Iterable[Expr]) -> typing.List[Expr]:
+    """The canonical forms of `exprs`, without duplicates, in order."""
+    out = []
+    ids = set()
+    for e in exprs:
+        e = intern(e)
+        if id(e) not in ids:
+            ids.add(id(e))
+            out.append(e)
+    return out
+
+
+def substitute(e: Expr, replacements: typing.Dict[int, Expr]) -> Expr:
+    """The canonical form of the canonical expression `e` with the
+    subexpressions whose ids are keys of `replacements` replaced by their
+    values. Subexpressions without any replaced descendants are shared with
+    `e`, and every subexpression is only visited once."""
+    memo: typing.Dict[int, Expr] = {}
+
+    def go(e: Expr) -> Expr:
+        if id(e) in replacements:
+            return replacements[id(e)]
+        elif id(e) in memo:
+            return memo[id(e)]
+
+        args = [go(a) if isinstance(a, Expr) else a for a in e.args]
+        if any(new is not old for new, old in zip(args, e.args)):
+            out = copy.copy(e)
+            out.args = args
+            out = intern(out)
+        else:
+            out = e
+        memo[id(e)] = out
+        return out
+
+    return go(e)
@@ -1,5 +1,6 @@
 from dataclasses import dataclass
 from metalift import ir
+from katara import hash_cons
 import typing
 import itertools
 
@@ -31,15 +32,17 @@ class MaxInt(Lattice):
     def merge(self, a: ir.Expr, b: ir.Expr) -> ir.Expr:
         a_var = ir.Var("max_merge_a", self.int_type)
         b_var = ir.Var("max_merge_b", self.int_type)
-        return ir.Let(
-            a_var, a, ir.Let(b_var, b, ir.Ite(ir.Ge(a_var, b_var), a_var, b_var))
+        return hash_cons.intern(
+            ir.Let(
+                a_var, a, ir.Let(b_var, b, ir.Ite(ir.Ge(a_var, b_var), a_var, b_var))
+            )
         )
 
     def bottom(self) -> ir.Expr:
-        return ir.Lit(0, self.int_type)
+        return hash_cons.intern(ir.Lit(0, self.int_type))
 
     def check_is_valid(self, v: ir.Expr) -> ir.Expr:
-        return ir.Ge(v, self.bottom())
+        return hash_cons.intern(ir.Ge(v, self.bottom()))
 
     def has_node_id(self) -> bool:
         return self.int_type == ir.NodeIDInt()
@@ -51,13 +54,13 @@ class OrBool(Lattice):
         return ir.Bool()
 
     def merge(self, a: ir.Expr, b: ir.Expr) -> ir.Expr:
-        return ir.Or(a, b)
+        return hash_cons.intern(ir.Or(a, b))
 
     def bottom(self) -> ir.Expr:
-        return ir.BoolLit(False)
+        return hash_cons.intern(ir.BoolLit(False))
 
     def check_is_valid(self, v: ir.Expr) -> ir.Expr:
-        return ir.BoolLit(True)
+        return hash_cons.intern(ir.BoolLit(True))
 
     def has_node_id(self) -> bool:
         return False
@@ -71,13 +74,13 @@ class Set(Lattice):
         return ir.SetT(self.innerType)
 
     def merge(self, a: ir.Expr, b: ir.Expr) -> ir.Expr:
-        return ir.Call("set-union", ir.SetT(self.innerType), a, b)
+        return hash_cons.intern(ir.Call("set-union", ir.SetT(self.innerType), a, b))
 
     def bottom(self) -> ir.Expr:
-        return ir.Call("set-create", ir.SetT(self.innerType))
+        return hash_cons.intern(ir.Call("set-create", ir.SetT(self.innerType)))
 
     def check_is_valid(self, v: ir.Expr) -> ir.Expr:
-        return ir.BoolLit(True)
+        return hash_cons.intern(ir.BoolLit(True))
 
     def has_node_id(self) -> bool:
         return self.innerType == ir.NodeIDInt()
@@ -95,34 +98,38 @@ class Map(Lattice):
         v_a = ir.Var("map_merge_a", self.valueType.ir_type())
         v_b = ir.Var("map_merge_b", self.valueType.ir_type())
 
-        return ir.Call(
-            "map-union",
-            ir.MapT(self.keyType, self.valueType.ir_type()),
-            a,
-            b,
-            ir.Lambda(
-                self.valueType.ir_type(), self.valueType.merge(v_a, v_b), v_a, v_b
-            ),
+        return hash_cons.intern(
+            ir.Call(
+                "map-union",
+                ir.MapT(self.keyType, self.valueType.ir_type()),
+                a,
+                b,
+                ir.Lambda(
+                    self.valueType.ir_type(), self.valueType.merge(v_a, v_b), v_a, v_b
+                ),
+            )
         )
 
     def bottom(self) -> ir.Expr:
-        return ir.Call("map-create", self.ir_type())
+        return hash_cons.intern(ir.Call("map-create", self.ir_type()))
 
     def check_is_valid(self, v: ir.Expr) -> ir.Expr:
         merge_a = ir.Var("merge_into", ir.Bool())
         merge_b = ir.Var("merge_v", self.valueType.ir_type())
 
-        return ir.Call(
-            "reduce_bool",
-            ir.Bool(),
-            ir.Call("map-values", ir.ListT(self.valueType.ir_type()), v),
-            ir.Lambda(
+        return hash_cons.intern(
+            ir.Call(
+                "reduce_bool",
                 ir.Bool(),
-                ir.And(merge_a, self.valueType.check_is_valid(merge_b)),
-                merge_b,
-                merge_a,
-            ),
-            ir.BoolLit(True),
+                ir.Call("map-values", ir.ListT(self.valueType.ir_type()), v),
+                ir.Lambda(
+                    ir.Bool(),
+                    ir.And(merge_a, self.valueType.check_is_valid(merge_b)),
+                    merge_b,
+                    merge_a,
+                ),
+                ir.BoolLit(True),
+            )
         )
 
     def has_node_id(self) -> bool:
@@ -149,43 +156,47 @@ class LexicalProduct(Lattice):
         keyMerged = self.l1.merge(keyA, keyB)
         valueMerged = self.l2.merge(valueA, valueB)
 
-        return ir.Let(
-            mergeA,
-            a,
+        return hash_cons.intern(
             ir.Let(
-                mergeB,
-                b,
-                ir.Tuple(
-                    keyMerged,
-                    ir.Ite(
-                        ir.Or(
-                            ir.Eq(keyA, keyB),
-                            ir.And(
-                                ir.Not(ir.Eq(keyA, keyMerged)),
-                                ir.Not(ir.Eq(keyB, keyMerged)),
+                mergeA,
+                a,
+                ir.Let(
+                    mergeB,
+                    b,
+                    ir.Tuple(
+                        keyMerged,
+                        ir.Ite(
+                            ir.Or(
+                                ir.Eq(keyA, keyB),
+                                ir.And(
+                                    ir.Not(ir.Eq(keyA, keyMerged)),
+                                    ir.Not(ir.Eq(keyB, keyMerged)),
+                                ),
                             ),
-                        ),
-                        valueMerged,
-                        self.l2.merge(
-                            ir.Ite(
-                                ir.Eq(keyA, keyMerged),
-                                valueA,
-                                valueB,
+                            valueMerged,
+                            self.l2.merge(
+                                ir.Ite(
+                                    ir.Eq(keyA, keyMerged),
+                                    valueA,
+                                    valueB,
+                                ),
+                                self.l2.bottom(),
                             ),
-                            self.l2.bottom(),
                         ),
                     ),
                 ),
-            ),
+            )
         )
 
     def bottom(self) -> ir.Expr:
-        return ir.Tuple(self.l1.bottom(), self.l2.bottom())
+        return hash_cons.intern(ir.Tuple(self.l1.bottom(), self.l2.bottom()))
 
     def check_is_valid(self, v: ir.Expr) -> ir.Expr:
-        return ir.And(
-            self.l1.check_is_valid(ir.TupleGet(v, ir.IntLit(0))),
-            self.l2.check_is_valid(ir.TupleGet(v, ir.IntLit(1))),
+        return hash_cons.intern(
+            ir.And(
+                self.l1.check_is_valid(ir.TupleGet(v, ir.IntLit(0))),
+                self.l2.check_is_valid(ir.TupleGet(v, ir.IntLit(1))),
+            )
         )
 
     def has_node_id(self) -> bool:
@@ -212,43 +223,196 @@ set_supported_elem = {ir.Int().name, ir.OpaqueInt().name}
 map_supported_elem = {ir.OpaqueInt().name, ir.NodeIDInt().name}
 
 
-def gen_lattice_types(max_depth: int) -> typing.Iterator[Lattice]:
+# the number of times the original recursive enumeration generates each
+# lattice, by depth, in order of first appearance
+_lattice_type_counts: typing.Dict[int, typing.Dict[Lattice, int]] = {}
+
+
+def _count_lattice_types(max_depth: int) -> typing.Dict[Lattice, int]:
+    if max_depth in _lattice_type_counts:
+        return _lattice_type_counts[max_depth]
+
+    counts: typing.Dict[Lattice, int] = {}
+
+    def add(lattice: Lattice, count: int) -> None:
+        if count > 0:
+            counts[lattice] = counts.get(lattice, 0) + count
+
+    if max_depth == 1:
+        add(OrBool(), 1)
+
+    for innerType in gen_types(max_depth):
+        if innerType.name in comparable_int:
+            add(MaxInt(innerType), 1)
+
+    if max_depth > 1:
+        inner = _count_lattice_types(max_depth - 1)
+        for innerLatticeType, count in inner.items():
+            add(innerLatticeType, count)
+
+        for innerType in gen_types(max_depth - 1):
+            if innerType.name in set_supported_elem:
+                add(Set(innerType), 1)
+
+        for keyType in gen_types(max_depth - 1):
+            if keyType.name in map_supported_elem:
+                for valueType, count in inner.items():
+                    add(Map(keyType, valueType), count)
+
+        # ordered pairs of distinct positions in the enumeration of the inner
+        # lattices, which pair a lattice with itself if it is repeated there
+        for l1, count1 in inner.items():
+            for l2, count2 in inner.items():
+                add(
+                    LexicalProduct(l1, l2),
+                    count1 * (count2 - 1) if l1 == l2 else count1 * count2,
+                )
+
+    _lattice_type_counts[max_depth] = counts
+    return counts
+
+
+# the original recursive enumeration of lattices, with its repetitions, by
+# depth
+_lattice_type_sequences: typing.Dict[int, typing.List[Lattice]] = {}
+
+
+def _lattice_type_sequence(max_depth: int) -> typing.List[Lattice]:
+    if max_depth in _lattice_type_sequences:
+        return _lattice_type_sequences[max_depth]
+
+    sequence: typing.List[Lattice] = []
     if max_depth == 1:
-        yield OrBool()
+        sequence.append(OrBool())
 
     for innerType in gen_types(max_depth):
         if innerType.name in comparable_int:
-            yield MaxInt(innerType)
+            sequence.append(MaxInt(innerType))
 
     if max_depth > 1:
-        for innerLatticeType in gen_lattice_types(max_depth - 1):
-            yield innerLatticeType
+        inner = _lattice_type_sequence(max_depth - 1)
+        sequence += inner
 
         for innerType in gen_types(max_depth - 1):
             if innerType.name in set_supported_elem:
-                yield Set(innerType)
+                sequence.append(Set(innerType))
 
         for keyType in gen_types(max_depth - 1):
             if keyType.name in map_supported_elem:
-                for valueType in gen_lattice_types(max_depth - 1):
-                    yield Map(keyType, valueType)
+                for valueType in inner:
+                    sequence.append(Map(keyType, valueType))
+
+        for innerTypePair in itertools.permutations(inner, 2):
+            sequence.append(LexicalProduct(*innerTypePair))
 
-        for innerTypePair in itertools.permutations(
-            gen_lattice_types(max_depth - 1), 2
-        ):
-            yield LexicalProduct(*innerTypePair)
+    _lattice_type_sequences[max_depth] = sequence
+    return sequence
+
+
+def gen_lattice_types(max_depth: int) -> typing.Iterator[Lattice]:
+    """The distinct lattices of up to `max_depth` nested types. The
+    enumeration of each depth is computed once and reused by deeper ones."""
+    return iter(_count_lattice_types(max_depth))
+
+
+def is_chain(lattice: Lattice) -> bool:
+    """Whether every two values of the lattice are comparable."""
+    if isinstance(lattice, (MaxInt, OrBool)):
+        return True
+    elif isinstance(lattice, LexicalProduct):
+        return is_chain(lattice.l1) and is_chain(lattice.l2)
+    else:
+        return False
+
+
+def canonical_lattice(lattice: Lattice) -> Lattice:
+    """A representative of the lattices isomorphic to `lattice`.
+
+    Lexical products are right-associated when their first key is a chain:
+    ((a, b), c) and (a, (b, c)) then order and merge values the same way. With
+    incomparable values of a, the first merges the c values while the second
+    takes the c of the greater b, so those are left alone."""
+    if isinstance(lattice, Map):
+        return Map(lattice.keyType, canonical_lattice(lattice.valueType))
+    elif isinstance(lattice, LexicalProduct):
+        l1 = canonical_lattice(lattice.l1)
+        l2 = canonical_lattice(lattice.l2)
+        if isinstance(l1, LexicalProduct) and is_chain(l1.l1):
+            return canonical_lattice(LexicalProduct(l1.l1, LexicalProduct(l1.l2, l2)))
+        return LexicalProduct(l1, l2)
+    else:
+        return lattice
+
+
+_structure_components: typing.Dict[int, typing.List[Lattice]] = {}
+
+
+def structure_components(max_depth: int) -> typing.List[Lattice]:
+    """The lattices tuples of type depth `max_depth` are built from when
+    pruning isomorphic structures: the first lattice of each
+    `canonical_lattice`. Lattices kept at a depth are also kept at all deeper
+    ones."""
+    if max_depth not in _structure_components:
+        representatives: typing.Dict[Lattice, Lattice] = {}
+        for lattice in gen_lattice_types(max_depth):
+            representatives.setdefault(canonical_lattice(lattice), lattice)
+        _structure_components[max_depth] = list(representatives.values())
+    return _structure_components[max_depth]
+
+
+def gen_structures(
+    max_depth: int, prune_isomorphic: bool = True
+) -> typing.Iterator[typing.Any]:
+    """Enumerate multisets of lattices by increasing type depth and tuple size.
+
+    With `prune_isomorphic`, a tuple of a given size is generated at the first
+    type depth that allows both its size and all its components, so no record
+    of the tuples generated so far is needed, and only one of the tuples whose
+    components have the same `canonical_lattice`s, in any order, is
+    generated.
+
+    Without it, the original enumeration is reproduced exactly. It also
+    generates some tuples again with their components in a different order, so
+    the tuples generated so far are recorded to skip exact repeats."""
+    if not prune_isomorphic:
+        yield from _gen_all_structures(max_depth)
+        return
+
+    cur_type_depth = 1
+    while cur_type_depth <= max_depth:
+        print(f"Type depth: {cur_type_depth}")
+        components = structure_components(cur_type_depth)
+        shallower = (
+            set(structure_components(cur_type_depth - 1))
+            if cur_type_depth > 1
+            else set()
+        )
+        cur_tuple_size = 1
+        while cur_tuple_size <= cur_type_depth:
+            print(f"Tuple size: {cur_tuple_size}")
+            for lattice_types in itertools.combinations_with_replacement(
+                components, cur_tuple_size
+            ):
+                if cur_tuple_size < cur_type_depth and all(
+                    l in shallower for l in lattice_types
+                ):
+                    # already generated at a shallower type depth
+                    continue
+                yield lattice_types
+            cur_tuple_size += 1
+        cur_type_depth += 1
 
 
-def gen_structures(max_depth: int) -> typing.Iterator[typing.Any]:
+def _gen_all_structures(max_depth: int) -> typing.Iterator[typing.Any]:
     cur_type_depth = 1
-    seen = set()
+    seen: typing.Set[typing.Tuple[Lattice, ...]] = set()
     while cur_type_depth <= max_depth:
         print(f"Type depth: {cur_type_depth}")
         cur_tuple_size = 1
         while cur_tuple_size <= cur_type_depth:
             print(f"Tuple size: {cur_tuple_size}")
             for lattice_types in itertools.combinations_with_replacement(
-                gen_lattice_types(cur_type_depth), cur_tuple_size
+                _lattice_type_sequence(cur_type_depth), cur_tuple_size
             ):
                 if tuple(lattice_types) in seen:
                     continue
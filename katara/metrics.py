@@ -0,0 +1,217 @@
+import collections
+import http.server
+import os
+import tempfile
+import threading
+from time import time
+import typing
+
+from katara.candidate_scope import process_tree
+
+
+def _process_name(pid: int) -> str:
+    try:
+        with open(f"/proc/{pid}/comm") as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+
+def solver_process_count() -> int:
+    """The number of descendants of this process that are not Python
+    processes, such as Racket and CVC5 (Linux only)."""
+    own_name = _process_name(os.getpid())
+    return sum(
+        1 for pid in process_tree(os.getpid())[1:] if _process_name(pid) != own_name
+    )
+
+
+def _format_labels(labels: typing.Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = [
+        name
+        + '="'
+        + value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        + '"'
+        for name, value in sorted(labels.items())
+    ]
+    return "{" + ",".join(escaped) + "}"
+
+
+class SearchMetrics:
+    """Live counters and gauges of structure searches, in the Prometheus text
+    format.
+
+    With a `path`, the metrics are rewritten atomically every `interval`
+    seconds, as expected by the textfile collector of the node exporter. With
+    a `port`, they are also served over HTTP on localhost."""
+
+    def __init__(
+        self,
+        path: typing.Optional[str] = None,
+        port: typing.Optional[int] = None,
+        interval: float = 15.0,
+        labels: typing.Optional[typing.Dict[str, str]] = None,
+        rateWindow: float = 600.0,
+    ) -> None:
+        self.path = path
+        self.port = port
+        self.interval = interval
+        self.labels = labels or {}
+        self.rateWindow = rateWindow
+
+        self.lock = threading.Lock()
+        self.started = 0
+        self.outcomes: typing.Dict[str, int] = {}
+        self.retries: typing.Dict[str, int] = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.last_completion: typing.Optional[float] = None
+        self.completion_times: typing.Deque[float] = collections.deque()
+
+        self.stopped = threading.Event()
+        self.server: typing.Optional[http.server.ThreadingHTTPServer] = None
+
+    def candidate_started(self) -> None:
+        with self.lock:
+            self.started += 1
+
+    def candidate_finished(self, outcome: str, retries: typing.Dict[str, int]) -> None:
+        now = time()
+        with self.lock:
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+            for reason, count in retries.items():
+                self.retries[reason] = self.retries.get(reason, 0) + count
+            self.last_completion = now
+            self.completion_times.append(now)
+
+    def set_in_flight(self, in_flight: int, max_in_flight: int) -> None:
+        with self.lock:
+            self.in_flight = in_flight
+            self.max_in_flight = max_in_flight
+
+    def render(self) -> str:
+        now = time()
+        with self.lock:
+            while (
+                self.completion_times
+                and self.completion_times[0] < now - self.rateWindow
+            ):
+                self.completion_times.popleft()
+            per_minute = len(self.completion_times) * 60 / self.rateWindow
+
+            lines: typing.List[str] = []
+
+            def metric(
+                name: str,
+                kind: str,
+                doc: str,
+                values: typing.List[typing.Tuple[typing.Dict[str, str], float]],
+            ) -> None:
+                lines.append(f"# HELP {name} {doc}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in values:
+                    lines.append(
+                        f"{name}{_format_labels({**self.labels, **labels})} {value}"
+                    )
+
+            metric(
+                "katara_search_candidates_started_total",
+                "counter",
+                "Candidates enqueued for synthesis.",
+                [({}, self.started)],
+            )
+            metric(
+                "katara_search_candidates_completed_total",
+                "counter",
+                "Candidates that finished synthesis, by outcome.",
+                [({"outcome": o}, n) for o, n in sorted(self.outcomes.items())],
+            )
+            metric(
+                "katara_search_candidates_per_minute",
+                "gauge",
+                f"Candidates completed per minute over the last {int(self.rateWindow)} seconds.",
+                [({}, per_minute)],
+            )
+            metric(
+                "katara_search_retries_total",
+                "counter",
+                "Escalations of the synthesis retry ladder, by reason.",
+                [({"reason": r}, n) for r, n in sorted(self.retries.items())],
+            )
+            metric(
+                "katara_search_in_flight",
+                "gauge",
+                "Candidates currently being synthesized.",
+                [({}, self.in_flight)],
+            )
+            metric(
+                "katara_search_max_in_flight",
+                "gauge",
+                "Limit on the number of candidates synthesized at once.",
+                [({}, self.max_in_flight)],
+            )
+            if self.last_completion is not None:
+                metric(
+                    "katara_search_last_completion_timestamp_seconds",
+                    "gauge",
+                    "Time the last candidate finished synthesis.",
+                    [({}, self.last_completion)],
+                )
+
+        metric(
+            "katara_search_solver_processes",
+            "gauge",
+            "Solver subprocesses currently running.",
+            [({}, solver_process_count())],
+        )
+        return "\n".join(lines) + "\n"
+
+    def write(self) -> None:
+        assert self.path is not None
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(self.render())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, self.path)
+
+    def _write_periodically(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def start(self) -> None:
+        if self.path is not None:
+            self.write()
+            threading.Thread(target=self._write_periodically, daemon=True).start()
+
+        if self.port is not None:
+            metrics = self
+
+            class Handler(http.server.BaseHTTPRequestHandler):
+                def do_GET(self) -> None:
+                    body = metrics.render().encode("utf-8")
+                    self.send_response(200)
+                    self.send_header(
+                        "Content-Type", "text/plain; version=0.0.4; charset=utf-8"
+                    )
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format: str, *args: typing.Any) -> None:
+                    pass
+
+            self.server = http.server.ThreadingHTTPServer(
+                ("127.0.0.1", self.port), Handler
+            )
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.path is not None:
+            self.write()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
@@ -0,0 +1,155 @@
+import typing
+from typing import Union
+
+from metalift.ir import Axiom, Expr, FnDecl, FnDeclNonRecursive, Synth, Var
+from metalift.synthesize_cvc5 import synthesize as synthesize_sygus
+
+from katara import telemetry
+from katara.synthesis import SynthesizeFun, backend_key, run_portfolio
+
+
+def synthesize_cvc5(
+    basename: str,
+    targetLang: typing.List[Union[FnDecl, FnDeclNonRecursive, Axiom]],
+    vars: typing.Set[Var],
+    invAndPs: typing.List[Synth],
+    preds: Union[str, typing.List[Expr]],
+    vc: Expr,
+    loopAndPsInfo: typing.List[Expr],
+    cvcPath: str = "cvc5",
+    uid: int = 0,
+    noVerify: bool = False,
+    unboundedInts: bool = False,
+    optimize_vc_equality: bool = False,
+    listBound: int = 2,
+    log: bool = True,
+) -> typing.List[FnDecl]:
+    """A `SynthesizeFun` that solves the problem as SyGuS with cvc5 directly,
+    instead of through Rosette. Options specific to Rosette are ignored.
+
+    The SyGuS backend names its files after the basename only, so the uid is
+    added to it, as the Rosette backend does, to keep concurrent candidates
+    from overwriting each other's files."""
+    return typing.cast(
+        typing.List[FnDecl],
+        synthesize_sygus(
+            f"{basename}_{uid}",
+            targetLang,
+            vars,
+            invAndPs,
+            preds,
+            vc,
+            loopAndPsInfo,
+            cvcPath,
+            noVerify=noVerify,
+            unboundedInts=unboundedInts,
+        ),
+    )
+
+
+class with_list_bound:
+    """`backend` with `extra` added to the bound on the length of lists."""
+
+    def __init__(self, backend: SynthesizeFun, extra: int) -> None:
+        self.backend = backend
+        self.extra = extra
+
+    def __repr__(self) -> str:
+        return f"with_list_bound({backend_key(self.backend)}, {self.extra})"
+
+    def __call__(
+        self,
+        basename: str,
+        targetLang: typing.List[Union[FnDecl, FnDeclNonRecursive, Axiom]],
+        vars: typing.Set[Var],
+        invAndPs: typing.List[Synth],
+        preds: Union[str, typing.List[Expr]],
+        vc: Expr,
+        loopAndPsInfo: typing.List[Expr],
+        cvcPath: str = "cvc5",
+        uid: int = 0,
+        noVerify: bool = False,
+        unboundedInts: bool = False,
+        optimize_vc_equality: bool = False,
+        listBound: int = 2,
+        log: bool = True,
+    ) -> typing.List[FnDecl]:
+        return self.backend(
+            basename,
+            targetLang,
+            vars,
+            invAndPs,
+            preds,
+            vc,
+            loopAndPsInfo,
+            cvcPath,
+            uid=uid,
+            noVerify=noVerify,
+            unboundedInts=unboundedInts,
+            optimize_vc_equality=optimize_vc_equality,
+            listBound=listBound + self.extra,
+            log=log,
+        )
+
+
+class race:
+    """A `SynthesizeFun` that runs every one of `backends` on the problem at
+    once, and returns the answer of the first one to succeed.
+
+    The solver processes of the other backends are killed, as long as they
+    were registered with `process_tracker`. Each backend writes its files
+    under its own basename, suffixed with `_r<i>`. A backend that crashes,
+    for example on a problem it does not support, only loses the race. If no
+    backend succeeds but one of them produced a design that failed
+    verification, its `VerificationFailed` is raised. With telemetry enabled,
+    every backend records a `backend` span, to compare backends across
+    problems."""
+
+    def __init__(self, backends: typing.List[SynthesizeFun]) -> None:
+        self.backends = backends
+
+    def __repr__(self) -> str:
+        return f"race([{', '.join(backend_key(b) for b in self.backends)}])"
+
+    def __call__(
+        self,
+        basename: str,
+        targetLang: typing.List[Union[FnDecl, FnDeclNonRecursive, Axiom]],
+        vars: typing.Set[Var],
+        invAndPs: typing.List[Synth],
+        preds: Union[str, typing.List[Expr]],
+        vc: Expr,
+        loopAndPsInfo: typing.List[Expr],
+        cvcPath: str = "cvc5",
+        uid: int = 0,
+        noVerify: bool = False,
+        unboundedInts: bool = False,
+        optimize_vc_equality: bool = False,
+        listBound: int = 2,
+        log: bool = True,
+    ) -> typing.List[FnDecl]:
+        def branch(i: int) -> typing.Callable[[], typing.List[FnDecl]]:
+            def run() -> typing.List[FnDecl]:
+                with telemetry.span("backend", uid=uid, backend=i):
+                    return self.backends[i](
+                        f"{basename}_r{i}",
+                        targetLang,
+                        vars,
+                        invAndPs,
+                        preds,
+                        vc,
+                        loopAndPsInfo,
+                        cvcPath,
+                        uid=uid,
+                        noVerify=noVerify,
+                        unboundedInts=unboundedInts,
+                        optimize_vc_equality=optimize_vc_equality,
+                        listBound=listBound,
+                        log=log,
+                    )
+
+            return run
+
+        return run_portfolio(
+            uid, [branch(i) for i in range(len(self.backends))], tolerateCrashes=True
+        )
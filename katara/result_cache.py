@@ -0,0 +1,104 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import typing
+
+from metalift.synthesis_common import SynthesisFailed, VerificationFailed
+
+from katara.candidate_scope import current_scope
+
+_file_digests: typing.Dict[typing.Tuple[str, int, int], str] = {}
+_file_digests_lock = threading.Lock()
+
+
+def file_digest(path: str) -> str:
+    """Hash of the contents of a file, memoized on its modification time."""
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    with _file_digests_lock:
+        if memo_key in _file_digests:
+            return _file_digests[memo_key]
+
+    with open(path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+
+    with _file_digests_lock:
+        _file_digests[memo_key] = digest
+    return digest
+
+
+class ResultCache:
+    """A persistent store of synthesis outcomes, keyed by a hash of the full
+    synthesis problem (sequential program, grammars, VC and bounds).
+
+    Failures are cached as well, so re-running or widening a search only pays
+    for candidates that have not been attempted before. Entries are written
+    atomically, so a cache directory can be shared by concurrent searches."""
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+
+    def problem_key(
+        self, filename: str, loopsFile: str, *problem: typing.Any, **bounds: typing.Any
+    ) -> str:
+        h = hashlib.sha256()
+        h.update(file_digest(filename).encode("utf-8"))
+        if os.path.exists(loopsFile):
+            h.update(file_digest(loopsFile).encode("utf-8"))
+        for part in problem:
+            h.update(repr(part).encode("utf-8"))
+        for name in sorted(bounds.keys()):
+            h.update(f"{name}={bounds[name]!r}".encode("utf-8"))
+        return h.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + ".pickle")
+
+    def get(self, key: str) -> typing.Optional[typing.Tuple[str, typing.Any]]:
+        try:
+            with open(self._path(key), "rb") as f:
+                return typing.cast(typing.Tuple[str, typing.Any], pickle.load(f))
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def put(self, key: str, outcome: str, value: typing.Any = None) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump((outcome, value), f)
+        os.replace(tmp_path, path)
+
+    def run(
+        self,
+        key: str,
+        synthesize: typing.Callable[[], typing.Any],
+    ) -> typing.Any:
+        """Replay the cached outcome for `key`, or compute and record it."""
+        cached = self.get(key)
+        if cached is not None:
+            outcome, value = cached
+            if outcome == "verification_failed":
+                raise VerificationFailed(value)
+            elif outcome == "failed":
+                raise SynthesisFailed(value)
+            else:
+                return value
+
+        try:
+            out = synthesize()
+        except (SynthesisFailed, VerificationFailed) as e:
+            # a failure caused by cancelling the candidate says nothing about
+            # the problem itself
+            scope = current_scope()
+            if scope is None or scope.cancelled is None:
+                if isinstance(e, VerificationFailed):
+                    self.put(key, "verification_failed", str(e))
+                else:
+                    self.put(key, "failed", str(e))
+            raise
+
+        self.put(key, "success", out)
+        return out
@@ -0,0 +1,389 @@
+from multiprocessing.managers import BaseManager
+import multiprocessing as mp
+import queue
+import secrets
+import threading
+from time import time
+import typing
+
+from katara.candidate_scope import CandidateBudget
+from katara.cegis import CounterexampleBank
+from katara.result_cache import ResultCache
+from katara.search_structures import (
+    NO_DEPTH_LIMIT,
+    CandidateResult,
+    CandidateTask,
+    SearchProblem,
+    _init_candidate_worker,
+    run_candidate_task,
+)
+
+# (search generation, task, budget)
+_BrokerTask = typing.Tuple[int, CandidateTask, typing.Optional[CandidateBudget]]
+# (search generation, result)
+_BrokerResult = typing.Tuple[int, CandidateResult]
+
+
+class _BrokerState:
+    """The state shared by the coordinator and the workers of a broker.
+
+    Every search run through the broker gets a new generation, so that tasks
+    and results left over from an earlier search are ignored."""
+
+    def __init__(self, tasks: "queue.Queue[_BrokerTask]") -> None:
+        self.tasks = tasks
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.active = False
+        self.is_closed = False
+        # slots and time of the last heartbeat of the connected workers, by id
+        self.workers: typing.Dict[int, typing.Tuple[int, float]] = {}
+        self.next_worker = 0
+        # the worker running each candidate of the current search, by uid
+        self.owners: typing.Dict[int, int] = {}
+        # candidates of the current search at a greater base depth are cancelled
+        self.max_depth = NO_DEPTH_LIMIT
+
+    def begin(self) -> int:
+        with self.lock:
+            self.generation += 1
+            self.active = True
+            self.owners = {}
+            self.max_depth = NO_DEPTH_LIMIT
+            return self.generation
+
+    def finish(self) -> None:
+        with self.lock:
+            self.active = False
+
+    def current(self) -> typing.Optional[int]:
+        with self.lock:
+            return self.generation if self.active else None
+
+    def register(self, slots: int) -> int:
+        with self.lock:
+            worker = self.next_worker
+            self.next_worker += 1
+            self.workers[worker] = (slots, time())
+            return worker
+
+    def unregister(self, worker: int) -> None:
+        with self.lock:
+            self.workers.pop(worker, None)
+
+    def heartbeat(self, worker: int) -> bool:
+        """Returns `False` if the worker was given up on and must register
+        again."""
+        with self.lock:
+            if worker not in self.workers:
+                return False
+            self.workers[worker] = (self.workers[worker][0], time())
+            return True
+
+    def take(self, worker: int, timeout: float) -> typing.Optional[_BrokerTask]:
+        """The next task for `worker`, if one arrives within `timeout` seconds.
+        Tasks of the current search are recorded as run by the worker before
+        they leave the broker, so that they are handed out again if it is
+        lost."""
+        with self.lock:
+            if worker not in self.workers:
+                return None
+        try:
+            generation, task, budget = self.tasks.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        with self.lock:
+            if generation == self.generation:
+                self.owners[task.uid] = worker
+        return (generation, task, budget)
+
+    def release(self, uid: int) -> None:
+        with self.lock:
+            self.owners.pop(uid, None)
+
+    def lost(self, timeout: float) -> typing.List[int]:
+        """Give up on the workers that sent no heartbeat for `timeout` seconds,
+        and return the uids of the candidates they were running."""
+        with self.lock:
+            now = time()
+            lost = {
+                worker
+                for worker, (_, last_seen) in self.workers.items()
+                if now - last_seen > timeout
+            }
+            for worker in lost:
+                del self.workers[worker]
+            uids = [
+                uid for uid, owner in self.owners.items() if owner not in self.workers
+            ]
+            for uid in uids:
+                del self.owners[uid]
+            return uids
+
+    def limit_depth(self, generation: int, depth: int) -> None:
+        with self.lock:
+            if generation == self.generation:
+                self.max_depth = min(self.max_depth, depth)
+
+    def depth_limit(self) -> int:
+        with self.lock:
+            return self.max_depth
+
+    def capacity(self) -> int:
+        with self.lock:
+            return sum(slots for slots, _ in self.workers.values())
+
+    def close(self) -> None:
+        with self.lock:
+            self.is_closed = True
+
+    def closed(self) -> bool:
+        with self.lock:
+            return self.is_closed
+
+
+# these live in the broker's server process
+_tasks: "queue.Queue[_BrokerTask]" = queue.Queue()
+_results: "queue.Queue[_BrokerResult]" = queue.Queue()
+_state = _BrokerState(_tasks)
+
+
+def _get_tasks() -> "queue.Queue[_BrokerTask]":
+    return _tasks
+
+
+def _get_results() -> "queue.Queue[_BrokerResult]":
+    return _results
+
+
+def _get_state() -> _BrokerState:
+    return _state
+
+
+class _BrokerManager(BaseManager):
+    pass
+
+
+_BrokerManager.register("tasks", callable=_get_tasks)
+_BrokerManager.register("results", callable=_get_results)
+_BrokerManager.register("state", callable=_get_state)
+
+
+def parse_address(address: str) -> typing.Tuple[str, int]:
+    host, port = address.rsplit(":", 1)
+    return (host, int(port))
+
+
+class SearchBroker:
+    """Hands out the candidates of a structure search to workers, possibly on
+    other hosts, which connect with `run_worker`.
+
+    The broker is a multiprocessing manager serving a task queue, a result
+    queue and the state of the current search over TCP. Finishing a search
+    (including on the first success) makes the workers cancel the candidates
+    they are running.
+
+    Workers send a heartbeat every few seconds. The candidates of a worker
+    that sent none for `workerTimeout` seconds are handed out again."""
+
+    def __init__(
+        self,
+        address: typing.Tuple[str, int] = ("", 0),
+        authkey: typing.Optional[bytes] = None,
+        workerTimeout: float = 60.0,
+    ) -> None:
+        # workers unpickle what the broker sends them, anyone with the key can
+        # run code on them
+        self.authkey = (
+            authkey if authkey is not None else secrets.token_hex(16).encode()
+        )
+        self.manager = _BrokerManager(address=address, authkey=self.authkey)
+        self.generation = 0
+        self.workerTimeout = workerTimeout
+        # the candidates of the current search without a result yet, by uid
+        self.outstanding: typing.Dict[
+            int, typing.Tuple[CandidateTask, typing.Optional[CandidateBudget]]
+        ] = {}
+
+    @property
+    def address(self) -> typing.Tuple[str, int]:
+        return typing.cast(typing.Tuple[str, int], self.manager.address)
+
+    def start(self) -> None:
+        self.manager.start()
+        self.tasks = self.manager.tasks()  # type: ignore
+        self.results = self.manager.results()  # type: ignore
+        self.state = self.manager.state()  # type: ignore
+
+    def shutdown(self) -> None:
+        self.state.close()
+        self.manager.shutdown()
+
+    def capacity(self) -> int:
+        """The number of candidates the connected workers can run at once."""
+        return typing.cast(int, self.state.capacity())
+
+    def begin(self) -> None:
+        self.generation = self.state.begin()
+        self.outstanding = {}
+
+    def submit(
+        self, task: CandidateTask, budget: typing.Optional[CandidateBudget] = None
+    ) -> None:
+        self.outstanding[task.uid] = (task, budget)
+        self.tasks.put((self.generation, task, budget))
+
+    def get_result(
+        self, timeout: typing.Optional[float] = None
+    ) -> typing.Optional[CandidateResult]:
+        """The next result of the current search, or `None` if none arrived
+        within `timeout` seconds. The candidates of lost workers are handed
+        out again first."""
+        self.requeue_lost()
+        deadline = None if timeout is None else time() + timeout
+        while True:
+            try:
+                generation, result = self.results.get(
+                    timeout=None if deadline is None else max(deadline - time(), 0)
+                )
+            except queue.Empty:
+                return None
+            # a candidate handed out again may report twice
+            if generation == self.generation and result[0] in self.outstanding:
+                del self.outstanding[result[0]]
+                return typing.cast(CandidateResult, result)
+
+    def requeue_lost(self) -> None:
+        for uid in self.state.lost(self.workerTimeout):
+            if uid in self.outstanding:
+                print(f"Lost the worker running #{uid}, handing it out again")
+                task, budget = self.outstanding[uid]
+                self.tasks.put((self.generation, task, budget))
+
+    def limit_depth(self, depth: int) -> None:
+        """Cancel the candidates of the current search at a base depth above
+        `depth`."""
+        self.state.limit_depth(self.generation, depth)
+
+    def finish(self) -> None:
+        self.state.finish()
+        while True:
+            try:
+                self.tasks.get(block=False)
+            except queue.Empty:
+                break
+
+
+def run_worker(
+    address: typing.Tuple[str, int],
+    authkey: bytes,
+    problemLoader: typing.Callable[[str], SearchProblem],
+    slots: int = max(mp.cpu_count() // 2, 1),
+    resultCache: typing.Optional[ResultCache] = None,
+    poll: float = 1.0,
+    counterexampleBank: typing.Optional[CounterexampleBank] = None,
+) -> None:
+    """Run candidates handed out by the `SearchBroker` at `address` on a pool
+    of `slots` processes, until the broker shuts down.
+
+    The worker sends a heartbeat to the broker at least every `poll` seconds,
+    and passes on the base depth limit of the current search (see
+    `SearchBroker.limit_depth`) to its pool as often.
+    If the broker gave up on it, for example after a long pause, it registers
+    again as a new worker."""
+    manager = _BrokerManager(address=address, authkey=authkey)
+    manager.connect()
+    tasks = manager.tasks()  # type: ignore
+    results = manager.results()  # type: ignore
+    state = manager.state()  # type: ignore
+
+    free_slots = threading.Semaphore(slots)
+    depth_limit = mp.Value("i", NO_DEPTH_LIMIT)
+    pool = mp.Pool(slots, initializer=_init_candidate_worker, initargs=(depth_limit,))
+    # the generation of the search whose candidates are running, if any
+    running: typing.Optional[int] = None
+    worker = state.register(slots)
+    try:
+        while not state.closed():
+            if not state.heartbeat(worker):
+                print("The broker gave up on this worker, registering again")
+                worker = state.register(slots)
+            current = state.current()
+            if running is not None and running != current:
+                # the search finished, stop the candidates that are left
+                print(f"Search {running} finished, cancelling its candidates")
+                pool.terminate()
+                depth_limit = mp.Value("i", NO_DEPTH_LIMIT)
+                pool = mp.Pool(
+                    slots, initializer=_init_candidate_worker, initargs=(depth_limit,)
+                )
+                free_slots = threading.Semaphore(slots)
+                running = None
+            elif running is not None:
+                depth_limit.value = state.depth_limit()
+
+            if not free_slots.acquire(timeout=poll):
+                continue
+            taken = state.take(worker, poll)
+            if taken is None:
+                free_slots.release()
+                continue
+            generation, task, budget = taken
+            current = state.current()
+            if generation != current or running not in (None, current):
+                free_slots.release()
+                if generation == current:
+                    # a new search started while waiting, the candidates of
+                    # the previous one are cancelled first
+                    state.release(task.uid)
+                    tasks.put((generation, task, budget))
+                continue
+
+            print(
+                f"Running #{task.uid} (structure: {list(task.synthStateStructure)}, base depth: {task.baseDepth})"
+            )
+            running = generation
+
+            def report(
+                result: CandidateResult,
+                generation: int = generation,
+                slot: threading.Semaphore = free_slots,
+            ) -> None:
+                results.put((generation, result))
+                state.release(result[0])
+                slot.release()
+
+            def report_crash(
+                e: BaseException,
+                generation: int = generation,
+                task: CandidateTask = task,
+                slot: threading.Semaphore = free_slots,
+            ) -> None:
+                report(
+                    (
+                        task.uid,
+                        list(task.synthStateStructure),
+                        task.baseDepth,
+                        repr(e),
+                        "crash",
+                        {},
+                    ),
+                    generation,
+                    slot,
+                )
+
+            pool.apply_async(
+                run_candidate_task,
+                args=(problemLoader, task, resultCache, budget, counterexampleBank),
+                callback=report,
+                error_callback=report_crash,
+            )
+    except (EOFError, ConnectionError):
+        # the broker went away
+        pass
+    finally:
+        pool.terminate()
+        try:
+            state.unregister(worker)
+        except (EOFError, ConnectionError):
+            pass
@@ -0,0 +1,85 @@
+import os
+import pickle
+import tempfile
+import typing
+
+
+class SearchCheckpoint:
+    """Progress of a structure search, saved so that it can be resumed.
+
+    `position` counts how many candidates have been drawn from the candidate
+    stream. Candidates before that position have either been decided (their
+    outcomes are in the search report), were skipped as infeasible, or are
+    still in `in_flight` and must be re-enqueued when resuming. Candidates that were
+    drawn but not yet enqueued, e.g. because they were buffered for
+    scheduling, are kept in `pending`.
+
+    The search saves the checkpoint whenever a candidate is enqueued or
+    decided, so that a search that is killed only reruns the candidates that
+    were in flight."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.position = 0
+        self.next_uid = 0
+        self.in_flight: typing.Dict[int, typing.Tuple[int, typing.Any]] = {}
+        self.pending: typing.List[typing.Tuple[int, typing.Any]] = []
+        self.finished = False
+
+    @staticmethod
+    def load(path: str) -> "SearchCheckpoint":
+        checkpoint = SearchCheckpoint(path)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                state = pickle.load(f)
+            checkpoint.position = state["position"]
+            checkpoint.next_uid = state["next_uid"]
+            checkpoint.in_flight = state["in_flight"]
+            checkpoint.pending = state.get("pending", [])
+        return checkpoint
+
+    def complete(self, uid: int) -> None:
+        self.in_flight.pop(uid, None)
+
+    def save(self) -> None:
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(
+                {
+                    "position": self.position,
+                    "next_uid": self.next_uid,
+                    "in_flight": self.in_flight,
+                    "pending": self.pending,
+                },
+                f,
+            )
+        os.replace(tmp_path, self.path)
+
+    def trim_report(self, reportFile: str) -> None:
+        """Drop the rows of the search report `reportFile` for candidates
+        that are run again when resuming, which are those in flight and those
+        enqueued after the checkpoint was saved, so that every candidate has
+        a single row once the search is resumed."""
+        if not os.path.exists(reportFile):
+            return
+        with open(reportFile) as f:
+            rows = f.readlines()
+        kept = []
+        for row in rows:
+            uid = int(row.split(",", 1)[0])
+            if uid < self.next_uid and uid not in self.in_flight:
+                kept.append(row)
+        if len(kept) == len(rows):
+            return
+        directory = os.path.dirname(os.path.abspath(reportFile))
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, "w") as f:
+            f.writelines(kept)
+        os.replace(tmp_path, reportFile)
+
+    def discard(self) -> None:
+        """Mark the search as finished, there is nothing left to resume."""
+        self.finished = True
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -1,31 +1,95 @@
 from __future__ import annotations
 
+import collections
+import csv
+import math
 import multiprocessing as mp
 import multiprocessing.pool
+import multiprocessing.sharedctypes
+import os
 import queue
+import re
+import signal
+import threading
 from time import time
 import traceback
 import typing
 
+from katara import analysis_cache, telemetry
+from katara.candidate_scope import CandidateBudget, CandidateScope, candidate_scope
+from katara.cegis import CounterexampleBank
+from katara.concurrency import ConcurrencyController
 from katara.lattices import Lattice
+from katara.result_cache import ResultCache
+from katara.search_checkpoint import SearchCheckpoint
 from metalift import process_tracker
 from metalift import ir
 from metalift.ir import Expr, FnDecl
 from katara.synthesis import SynthesizeFun, synthesize_crdt
 from metalift.synthesis_common import SynthesisFailed
 
-from typing import Any, Callable, Iterator, List, Optional, Tuple
+from typing import Any, Callable, Iterator, List, NamedTuple, Optional, Tuple
+
+if typing.TYPE_CHECKING:
+    from katara.metrics import SearchMetrics
+    from katara.search_broker import SearchBroker
+
+
+class SearchProblem(NamedTuple):
+    """Everything needed to synthesize a candidate besides its lattice structure.
+
+    Process-mode workers rebuild this from a benchmark name, since the grammar
+    and ordering callbacks are usually closures that cannot be pickled."""
+
+    initState: Callable[[Any], Expr]
+    grammarStateInvariant: Callable[[Expr, Any, int, int], Expr]
+    grammarSupportedCommand: Callable[[Expr, Any, Any, int, int], Expr]
+    inOrder: Callable[[Any, Any], Expr]
+    opPrecondition: Callable[[Any], Expr]
+    grammar: Callable[[Expr, List[ir.Var], Any, int], Expr]
+    grammarQuery: Callable[[str, List[ir.Var], ir.Type, int], ir.Synth]
+    grammarEquivalence: Callable[[Expr, Expr, List[ir.Var], int], Expr]
+    targetLang: Callable[
+        [], List[typing.Union[FnDecl, ir.FnDeclNonRecursive, ir.Axiom]]
+    ]
+    synthesize: SynthesizeFun
+    filename: str
+    fnNameBase: str
+    loopsFile: str
+    cvcPath: str
+    stateTypeHint: Optional[ir.Type] = None
+    opArgTypeHint: Optional[List[ir.Type]] = None
+    queryArgTypeHint: Optional[List[ir.Type]] = None
+    queryRetTypeHint: Optional[ir.Type] = None
+
+
+class CandidateTask(NamedTuple):
+    """A picklable description of a single candidate to synthesize."""
+
+    uid: int
+    benchmark: str
+    synthStateStructure: Tuple[Lattice, ...]
+    baseDepth: int
+    useOpList: bool
+    portfolio: bool = False
+    cegisRounds: int = 0
+
+
+# (uid, structure, baseDepth, synthesized functions or crash traceback, outcome)
+# where the outcome is one of "success", "failure", "crash", "timeout" or "oom",
+# and the number of times synthesis was retried, by reason
+CandidateResult = Tuple[
+    int,
+    Any,
+    int,
+    Optional[typing.Union[str, List[FnDecl]]],
+    str,
+    typing.Dict[str, int],
+]
 
 
 def synthesize_crdt_e2e(
-    queue: queue.Queue[
-        Tuple[
-            int,
-            Any,
-            int,
-            Optional[typing.Union[str, List[FnDecl]]],
-        ]
-    ],
+    queue: queue.Queue[CandidateResult],
     synthStateStructure: List[Lattice],
     initState: Callable[[Any], Expr],
     grammarStateInvariant: Callable[[Expr, Any, int, int], Expr],
@@ -50,16 +114,23 @@ def synthesize_crdt_e2e(
     loopsFile: str,
     cvcPath: str,
     uid: int,
+    resultCache: Optional[ResultCache] = None,
+    budget: Optional[CandidateBudget] = None,
+    scope: Optional[CandidateScope] = None,
+    portfolio: bool = False,
+    cegisRounds: int = 0,
+    counterexampleBank: Optional[CounterexampleBank] = None,
 ) -> None:
     synthStateType = ir.TupleT(*[a.ir_type() for a in synthStateStructure])
+    if scope is None:
+        scope = CandidateScope(uid, *(budget.for_depth(baseDepth) if budget else ()))
 
-    try:
-        queue.put(
-            (
-                uid,
-                synthStateStructure,
-                baseDepth,
-                synthesize_crdt(
+    with telemetry.span(
+        "candidate", uid=uid, baseDepth=baseDepth, structure=str(synthStateStructure)
+    ) as record:
+        try:
+            with candidate_scope(scope):
+                result = synthesize_crdt(
                     filename,
                     fnNameBase,
                     loopsFile,
@@ -89,13 +160,448 @@ def synthesize_crdt_e2e(
                     queryRetTypeHint=queryRetTypeHint,
                     baseDepth=baseDepth,
                     log=False,
+                    resultCache=resultCache,
+                    portfolio=portfolio,
+                    cegisRounds=cegisRounds,
+                    counterexampleBank=counterexampleBank,
+                )
+            record["outcome"] = "success"
+            queue.put(
+                (
+                    uid,
+                    synthStateStructure,
+                    baseDepth,
+                    result,
+                    "success",
+                    dict(scope.retries),
+                )
+            )
+        except SynthesisFailed:
+            record["outcome"] = scope.cancelled or "failure"
+            queue.put(
+                (
+                    uid,
+                    synthStateStructure,
+                    baseDepth,
+                    None,
+                    scope.cancelled or "failure",
+                    dict(scope.retries),
+                )
+            )
+        except:
+            if scope.cancelled is not None:
+                # killing the solver can surface as arbitrary errors
+                record["outcome"] = scope.cancelled
+                queue.put(
+                    (
+                        uid,
+                        synthStateStructure,
+                        baseDepth,
+                        None,
+                        scope.cancelled,
+                        dict(scope.retries),
+                    )
+                )
+            else:
+                record["outcome"] = "crash"
+                queue.put(
+                    (
+                        uid,
+                        synthStateStructure,
+                        baseDepth,
+                        traceback.format_exc(),
+                        "crash",
+                        dict(scope.retries),
+                    )
+                )
+
+
+# no candidate is cancelled for its base depth
+NO_DEPTH_LIMIT = 2**31 - 1
+
+# the largest base depth still worth synthesizing, shared with the process
+# that owns the pool (see preferShallowest in search_crdt_structures)
+_depth_limit: Optional["multiprocessing.sharedctypes.Synchronized[int]"] = None
+
+
+def _init_candidate_worker(
+    depthLimit: Optional["multiprocessing.sharedctypes.Synchronized[int]"] = None,
+) -> None:
+    global _depth_limit
+    _depth_limit = depthLimit
+
+    # Pool.terminate() sends SIGTERM to the workers, make sure the solver
+    # processes they spawned go down with them
+    def on_terminate(signum: int, frame: Any) -> None:
+        for p in process_tracker.all_processes:
+            p.terminate()
+        os._exit(1)
+
+    signal.signal(signal.SIGTERM, on_terminate)
+
+
+def _cancel_if_too_deep(
+    scope: CandidateScope,
+    baseDepth: int,
+    depthLimit: "multiprocessing.sharedctypes.Synchronized[int]",
+    done: threading.Event,
+) -> None:
+    while True:
+        if depthLimit.value < baseDepth:
+            scope.cancel("cancelled")
+            return
+        if done.wait(1.0):
+            return
+
+
+def run_candidate_task(
+    problemLoader: Callable[[str], SearchProblem],
+    task: CandidateTask,
+    resultCache: Optional[ResultCache] = None,
+    budget: Optional[CandidateBudget] = None,
+    counterexampleBank: Optional[CounterexampleBank] = None,
+) -> CandidateResult:
+    problem = problemLoader(task.benchmark)
+    results: queue.Queue[CandidateResult] = queue.Queue()
+    scope = CandidateScope(
+        task.uid, *(budget.for_depth(task.baseDepth) if budget else ())
+    )
+    done = threading.Event()
+    if _depth_limit is not None:
+        threading.Thread(
+            target=_cancel_if_too_deep,
+            args=(scope, task.baseDepth, _depth_limit, done),
+            daemon=True,
+        ).start()
+    try:
+        synthesize_crdt_e2e(
+            results,
+            list(task.synthStateStructure),
+            problem.initState,
+            problem.grammarStateInvariant,
+            problem.grammarSupportedCommand,
+            problem.inOrder,
+            problem.opPrecondition,
+            problem.grammar,
+            problem.grammarQuery,
+            problem.grammarEquivalence,
+            problem.targetLang,
+            problem.synthesize,
+            task.useOpList,
+            problem.stateTypeHint,
+            problem.opArgTypeHint,
+            problem.queryArgTypeHint,
+            problem.queryRetTypeHint,
+            task.baseDepth,
+            problem.filename,
+            problem.fnNameBase,
+            problem.loopsFile,
+            problem.cvcPath,
+            task.uid,
+            resultCache,
+            budget,
+            scope,
+            portfolio=task.portfolio,
+            cegisRounds=task.cegisRounds,
+            counterexampleBank=counterexampleBank,
+        )
+    finally:
+        done.set()
+    return results.get()
+
+
+def structure_is_feasible(
+    problem: SearchProblem, useOpList: bool, baseDepth: int, structure: Any
+) -> bool:
+    """Whether the grammars of a candidate can be built at all, without
+    invoking the solver."""
+    with telemetry.span(
+        "prefilter", baseDepth=baseDepth, structure=str(structure)
+    ) as record:
+        try:
+            synthStateType = ir.TupleT(*[a.ir_type() for a in structure])
+            synthesize_crdt(
+                problem.filename,
+                problem.fnNameBase,
+                problem.loopsFile,
+                problem.cvcPath,
+                synthStateType,
+                lambda: problem.initState(structure),
+                lambda s, baseDepth, invariantBoost: problem.grammarStateInvariant(
+                    s,
+                    structure,
+                    baseDepth,
+                    invariantBoost,
+                ),
+                lambda s, a, baseDepth, invariantBoost: problem.grammarSupportedCommand(
+                    s,
+                    a,
+                    structure,
+                    baseDepth,
+                    invariantBoost,
                 ),
+                problem.inOrder,
+                problem.opPrecondition,
+                lambda inState, args, baseDepth: problem.grammar(
+                    inState,
+                    args,
+                    structure,
+                    baseDepth,
+                ),
+                problem.grammarQuery,
+                problem.grammarEquivalence,
+                problem.targetLang,
+                problem.synthesize,
+                useOpList=useOpList,
+                stateTypeHint=problem.stateTypeHint,
+                opArgTypeHint=problem.opArgTypeHint,
+                queryArgTypeHint=problem.queryArgTypeHint,
+                queryRetTypeHint=problem.queryRetTypeHint,
+                baseDepth=baseDepth,
+                log=False,
+                skipSynth=True,
             )
+            record["feasible"] = True
+            return True
+        except KeyError as k:
+            # this is due to a grammar not being able to find a value
+            record["feasible"] = False
+            return False
+
+
+# problems loaded by the feasibility workers of a process pool, by benchmark
+_loaded_problems: typing.Dict[str, SearchProblem] = {}
+
+
+def run_feasibility_task(
+    problemLoader: Callable[[str], SearchProblem],
+    benchmark: str,
+    useOpList: bool,
+    baseDepth: int,
+    structure: Tuple[Lattice, ...],
+) -> bool:
+    if benchmark not in _loaded_problems:
+        _loaded_problems[benchmark] = problemLoader(benchmark)
+    return structure_is_feasible(
+        _loaded_problems[benchmark], useOpList, baseDepth, list(structure)
+    )
+
+
+class FeasibilityPrefilter:
+    """Filters a stream of (baseDepth, structure) candidates down to the
+    feasible ones, checking up to `lookahead` upcoming candidates concurrently
+    on a separate pool so that the search does not wait on the checks.
+
+    Feasible candidates come out in the order of the underlying stream."""
+
+    def __init__(
+        self,
+        candidates: Iterator[Tuple[int, Any]],
+        check: Callable[[int, Any], "multiprocessing.pool.ApplyResult[bool]"],
+        lookahead: int,
+    ) -> None:
+        self.candidates = candidates
+        self.check = check
+        self.lookahead = max(lookahead, 1)
+        self.in_flight: typing.Deque[
+            Tuple[Tuple[int, Any], "multiprocessing.pool.ApplyResult[bool]"]
+        ] = collections.deque()
+
+    def __iter__(self) -> "FeasibilityPrefilter":
+        return self
+
+    def buffered(self) -> List[Tuple[int, Any]]:
+        """The candidates drawn from the stream that have not come out yet."""
+        return [candidate for candidate, _ in self.in_flight]
+
+    def __next__(self) -> Tuple[int, Any]:
+        while True:
+            while len(self.in_flight) < self.lookahead:
+                candidate = next(self.candidates, None)
+                if candidate is None:
+                    break
+                self.in_flight.append((candidate, self.check(*candidate)))
+
+            if not self.in_flight:
+                raise StopIteration
+
+            # only drop the candidate once it is checked, so that it is still
+            # buffered if the search is interrupted while waiting for it
+            candidate, feasible = self.in_flight[0]
+            is_feasible = feasible.get()
+            self.in_flight.popleft()
+            if is_feasible:
+                return candidate
+
+
+_lattice_names = {"MaxInt", "OrBool", "Set", "Map", "LexicalProduct"}
+_constructor_token = re.compile(r"(\w*)\(|\)")
+
+
+def structure_features(structure: Any, baseDepth: int) -> Tuple[float, ...]:
+    """Features of a candidate used by the `CostModel`: lattice depth, tuple
+    size, number of Map and LexicalProduct nodes and the base grammar depth.
+
+    These are computed from the printed structure, so that candidates read back
+    from search reports are treated the same way as live ones."""
+    lattice_depth = 0
+    max_lattice_depth = 0
+    tuple_size = 0
+    maps = 0
+    lexical_products = 0
+    open_constructors: List[bool] = []
+    for token in _constructor_token.finditer(str(structure)):
+        name = token.group(1)
+        if name is None:
+            if open_constructors and open_constructors.pop():
+                lattice_depth -= 1
+        else:
+            is_lattice = name in _lattice_names
+            open_constructors.append(is_lattice)
+            if is_lattice:
+                if lattice_depth == 0:
+                    tuple_size += 1
+                lattice_depth += 1
+                max_lattice_depth = max(max_lattice_depth, lattice_depth)
+                maps += name == "Map"
+                lexical_products += name == "LexicalProduct"
+
+    return (
+        1.0,
+        float(max_lattice_depth),
+        float(tuple_size),
+        float(maps),
+        float(lexical_products),
+        float(baseDepth),
+    )
+
+
+def _solve_linear(a: List[List[float]], b: List[float]) -> List[float]:
+    # Gaussian elimination with partial pivoting
+    n = len(b)
+    m = [row[:] + [b[i]] for i, row in enumerate(a)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(m[r][col]))
+        m[col], m[pivot] = m[pivot], m[col]
+        if abs(m[col][col]) < 1e-12:
+            continue
+        for r in range(n):
+            if r != col:
+                factor = m[r][col] / m[col][col]
+                for c in range(col, n + 1):
+                    m[r][c] -= factor * m[col][c]
+    return [m[i][n] / m[i][i] if abs(m[i][i]) >= 1e-12 else 0.0 for i in range(n)]
+
+
+class CostModel:
+    """Predicts how long a candidate will take to synthesize and how likely it
+    is to succeed, from the outcomes recorded in earlier search reports.
+
+    Synthesis time is modeled with a ridge regression on the log of the time,
+    and the success probability with per-feature success rates smoothed
+    towards the overall success rate."""
+
+    def __init__(
+        self,
+        weights: List[float],
+        outcomes: typing.Dict[Tuple[float, ...], Tuple[int, int]],
+        prior: float,
+        smoothing: float = 2.0,
+    ) -> None:
+        self.weights = weights
+        self.outcomes = outcomes
+        self.prior = prior
+        self.smoothing = smoothing
+
+    @staticmethod
+    def fit(reportFiles: typing.Iterable[str], ridge: float = 1.0) -> "CostModel":
+        samples: List[Tuple[Tuple[float, ...], float, bool]] = []
+        for reportFile in reportFiles:
+            with open(reportFile, newline="") as f:
+                for row in csv.reader(f):
+                    if len(row) < 5:
+                        continue
+                    baseDepth = int(row[5]) if len(row) > 5 else 1
+                    samples.append(
+                        (
+                            structure_features(row[2], baseDepth),
+                            float(row[1]),
+                            row[4] == "True",
+                        )
+                    )
+
+        n_features = len(structure_features((), 1))
+        xtx = [
+            [ridge if i == j and i > 0 else 0.0 for j in range(n_features)]
+            for i in range(n_features)
+        ]
+        xty = [0.0] * n_features
+        outcomes: typing.Dict[Tuple[float, ...], Tuple[int, int]] = {}
+        successes = 0
+        for features, took, success in samples:
+            log_time = math.log(max(took, 1e-3))
+            for i in range(n_features):
+                xty[i] += features[i] * log_time
+                for j in range(n_features):
+                    xtx[i][j] += features[i] * features[j]
+
+            total, succeeded = outcomes.get(features, (0, 0))
+            outcomes[features] = (total + 1, succeeded + success)
+            successes += success
+
+        weights = _solve_linear(xtx, xty) if samples else [0.0] * n_features
+        prior = (successes + 1) / (len(samples) + 2)
+        return CostModel(weights, outcomes, prior)
+
+    def expected_time(self, features: Tuple[float, ...]) -> float:
+        return math.exp(sum(w * x for w, x in zip(self.weights, features)))
+
+    def success_probability(self, features: Tuple[float, ...]) -> float:
+        total, succeeded = self.outcomes.get(features, (0, 0))
+        return (succeeded + self.smoothing * self.prior) / (total + self.smoothing)
+
+    def priority(self, baseDepth: int, structure: Any) -> float:
+        """Expected successes per second spent on the candidate."""
+        features = structure_features(structure, baseDepth)
+        return self.success_probability(features) / max(
+            self.expected_time(features), 1e-3
         )
-    except SynthesisFailed:
-        queue.put((uid, synthStateStructure, baseDepth, None))
-    except:
-        queue.put((uid, synthStateStructure, baseDepth, traceback.format_exc()))
+
+
+class CandidateScheduler:
+    """Reorders a stream of (baseDepth, structure) candidates within a window of
+    the next `lookahead` candidates, highest `CostModel` priority first. Ties
+    keep the order of the underlying stream."""
+
+    def __init__(
+        self,
+        candidates: Iterator[Tuple[int, Any]],
+        model: CostModel,
+        lookahead: int,
+    ) -> None:
+        self.candidates = candidates
+        self.model = model
+        self.lookahead = lookahead
+        self.window: List[Tuple[int, Any]] = []
+        self.priorities: List[float] = []
+
+    def __iter__(self) -> "CandidateScheduler":
+        return self
+
+    def __next__(self) -> Tuple[int, Any]:
+        while len(self.window) < self.lookahead:
+            candidate = next(self.candidates, None)
+            if candidate is None:
+                break
+            self.window.append(candidate)
+            self.priorities.append(self.model.priority(*candidate))
+
+        if not self.window:
+            raise StopIteration
+
+        best = max(range(len(self.window)), key=lambda i: (self.priorities[i], -i))
+        self.priorities.pop(best)
+        return self.window.pop(best)
 
 
 def search_crdt_structures(
@@ -125,10 +631,97 @@ def search_crdt_structures(
     maxThreads: int = mp.cpu_count(),
     upToUid: Optional[int] = None,
     exitFirstSuccess: bool = True,
+    useProcesses: bool = False,
+    benchmark: Optional[str] = None,
+    problemLoader: Optional[Callable[[str], SearchProblem]] = None,
+    resultCache: Optional[ResultCache] = None,
+    checkpoint: Optional[SearchCheckpoint] = None,
+    costModel: Optional[CostModel] = None,
+    lookahead: int = 32,
+    budget: Optional[CandidateBudget] = None,
+    prefilterWorkers: int = 1,
+    prefilterLookahead: int = 16,
+    broker: Optional[SearchBroker] = None,
+    shard: Optional[Tuple[int, int]] = None,
+    metrics: Optional[SearchMetrics] = None,
+    concurrency: Optional[ConcurrencyController] = None,
+    portfolio: bool = False,
+    preferShallowest: bool = False,
+    cegisRounds: int = 0,
+    counterexampleBank: Optional[CounterexampleBank] = None,
 ) -> Tuple[Any, List[ir.Expr]]:
-    q: queue.Queue[
-        Tuple[int, Any, int, Optional[typing.Union[str, List[Expr]]]]
-    ] = queue.Queue()
+    """Search over candidate lattice structures until one can be synthesized.
+
+    With `useProcesses`, candidates are synthesized in a process pool instead
+    of a thread pool, so grammar and VC construction are not serialized on the
+    GIL. Workers receive picklable `CandidateTask`s and rebuild the rest of the
+    problem with `problemLoader(benchmark)`, which must be a module-level
+    function.
+
+    If a `resultCache` is given, the outcome of every synthesis query is looked
+    up there before invoking the solver, and recorded afterwards.
+
+    If a `checkpoint` is given, the progress of the search is saved to it
+    whenever a candidate is enqueued or decided. A checkpoint loaded from an
+    interrupted search resumes it, as long as `structureCandidates` enumerates
+    the same candidates in the same order, and the report rows of the
+    candidates that are run again are replaced. The checkpoint is deleted once
+    the search succeeds or runs out of candidates.
+
+    If a `costModel` is given, candidates are reordered within a window of the
+    next `lookahead` candidates to try the most promising ones first.
+
+    Candidates whose grammars cannot be built are filtered out before they are
+    enqueued. These checks run on a separate pool of `prefilterWorkers` threads
+    (or processes, with `useProcesses`), up to `prefilterLookahead` candidates
+    ahead of the search.
+
+    If a `broker` is given, candidates are handed out to the workers connected
+    to it instead of being synthesized locally, and as many are kept in flight
+    as the workers have slots for.
+
+    With `shard` set to `(i, n)`, only the candidates of `structureCandidates`
+    whose position is `i` modulo `n` are tried, so that `n` independent
+    searches together cover all candidates. Their reports can be combined with
+    `tests/merge_reports.py`.
+
+    If `metrics` are given, they are kept up to date with the progress of the
+    search.
+
+    By default, up to `maxThreads // 2` candidates are synthesized at once. If
+    a `concurrency` controller is given, it adapts this limit to the load of
+    the host instead.
+
+    With `portfolio`, the escalations tried when a candidate fails to verify
+    run concurrently instead of one after the other, see `synthesize_crdt`.
+
+    With `preferShallowest`, the first success does not end the search right
+    away: no more candidates are enqueued, candidates in flight at a greater
+    base depth are cancelled (within a second with `useProcesses` or a
+    `broker`, whose workers poll for it), and those at a smaller base depth
+    are waited for. The result is the first success at the smallest base depth among the
+    candidates that were enqueued, so running several base depths of a fixed
+    structure at once gives the same design as trying them in order.
+
+    With `cegisRounds` above 0, a design that fails to verify is synthesized
+    again at the same bounds with the counterexample found by CVC5 as an
+    additional constraint, up to `cegisRounds` times per candidate, before
+    falling back to increasing the bounds.
+
+    If a `counterexampleBank` is given, the counterexamples found while
+    verifying candidates are banked, and replayed against the designs of later
+    candidates before verifying them in full. A design that fails on a banked
+    counterexample skips full verification. The number of such hits is the
+    last column of the report. Designs that pass functions as arguments are
+    verified by metalift, and only bank their counterexamples."""
+    if shard is not None and not 0 <= shard[0] < shard[1]:
+        raise ValueError(f"invalid shard {shard[0]}/{shard[1]}")
+    if useProcesses and (benchmark is None or problemLoader is None):
+        raise ValueError("process pool execution requires a benchmark and loader")
+    if broker is not None and benchmark is None:
+        raise ValueError("distributed execution requires a benchmark")
+
+    q: queue.Queue[CandidateResult] = queue.Queue()
     queue_size = 0
     next_uid = 0
 
@@ -136,135 +729,349 @@ def search_crdt_structures(
     next_res = None
 
     start_times = {}
+    # base depths of the candidates in flight, by uid
+    depths: typing.Dict[int, int] = {}
+    # (baseDepth, structure, result) of the shallowest success so far, with
+    # preferShallowest
+    shallowest: Optional[Tuple[int, Any, Any]] = None
+    # solver processes of the candidates in flight, by uid (thread pool only,
+    # process pool workers track their own)
+    scopes: typing.Dict[int, CandidateScope] = {}
+
+    # candidates that were in flight when the search was checkpointed
+    resumed: List[Tuple[int, int, Any]] = []
+    # candidates drawn from the stream but not yet enqueued when checkpointed
+    pending: List[Tuple[int, Any]] = []
+    resuming = checkpoint is not None and checkpoint.position > 0
+    # the number of candidates of the stream consumed before this run
+    skipped = 0
+    if checkpoint is not None and resuming:
+        print(
+            f"Resuming search from checkpoint ({checkpoint.position} candidates consumed, {len(checkpoint.in_flight)} in flight)"
+        )
+        for _ in range(checkpoint.position):
+            next(structureCandidates)
+        skipped = checkpoint.position
+        next_uid = checkpoint.next_uid
+        resumed = [
+            (uid, baseDepth, structure)
+            for uid, (baseDepth, structure) in sorted(checkpoint.in_flight.items())
+        ]
+        pending = list(checkpoint.pending)
+
+    def drawn_candidates() -> Iterator[Tuple[int, Any]]:
+        while pending:
+            yield pending.pop(0)
+        for index, candidate in enumerate(structureCandidates, start=skipped):
+            if checkpoint is not None:
+                checkpoint.position += 1
+            if shard is None or index % shard[1] == shard[0]:
+                yield candidate
+
+    problem = SearchProblem(
+        initState,
+        grammarStateInvariant,
+        grammarSupportedCommand,
+        inOrder,
+        opPrecondition,
+        grammar,
+        grammarQuery,
+        grammarEquivalence,
+        targetLang,
+        synthesize,
+        filename,
+        fnNameBase,
+        loopsFile,
+        cvcPath,
+        stateTypeHint,
+        opArgTypeHint,
+        queryArgTypeHint,
+        queryRetTypeHint,
+    )
+    # forked workers inherit the analyses instead of each redoing them
+    analysis_cache.warm(filename, fnNameBase, loopsFile)
+
+    prefilter_pool: multiprocessing.pool.Pool = (
+        mp.Pool(prefilterWorkers, initializer=_init_candidate_worker)
+        if useProcesses
+        else multiprocessing.pool.ThreadPool(prefilterWorkers)
+    )
+
+    def check_feasibility(
+        baseDepth: int, structure: Any
+    ) -> "multiprocessing.pool.ApplyResult[bool]":
+        if useProcesses:
+            return prefilter_pool.apply_async(
+                run_feasibility_task,
+                (problemLoader, benchmark, useOpList, baseDepth, tuple(structure)),
+            )
+        else:
+            return prefilter_pool.apply_async(
+                structure_is_feasible, (problem, useOpList, baseDepth, structure)
+            )
+
+    prefilter = FeasibilityPrefilter(
+        drawn_candidates(), check_feasibility, prefilterLookahead
+    )
+    candidates: Iterator[Tuple[int, Any]] = prefilter
+    scheduler = None
+    if costModel is not None:
+        scheduler = CandidateScheduler(candidates, costModel, lookahead)
+        candidates = scheduler
+
+    def save_checkpoint() -> None:
+        assert checkpoint is not None
+        checkpoint.pending = (
+            (scheduler.window if scheduler else []) + prefilter.buffered() + pending
+        )
+        checkpoint.save()
+
+    def enqueue(
+        pool: Optional[multiprocessing.pool.Pool],
+        uid: int,
+        baseDepth: int,
+        structure: Any,
+    ) -> None:
+        print(f"Enqueueing #{uid} (structure: {structure}, base depth: {baseDepth})")
+        start_times[uid] = time()
+        depths[uid] = baseDepth
+        if metrics is not None:
+            metrics.candidate_started()
+        task = CandidateTask(
+            uid,
+            benchmark,  # type: ignore
+            tuple(structure),
+            baseDepth,
+            useOpList,
+            portfolio,
+            cegisRounds,
+        )
+        if broker is not None:
+            broker.submit(task, budget)
+        elif useProcesses:
+            assert pool is not None
+
+            def report_crash(e: BaseException) -> None:
+                q.put((uid, structure, baseDepth, repr(e), "crash", {}))
+
+            pool.apply_async(
+                run_candidate_task,
+                args=(problemLoader, task, resultCache, budget, counterexampleBank),
+                callback=q.put,
+                error_callback=report_crash,
+            )
+        else:
+            assert pool is not None
+            scope = CandidateScope(
+                uid, *(budget.for_depth(baseDepth) if budget else ())
+            )
+            scopes[uid] = scope
+
+            def error_callback(e: BaseException) -> None:
+                raise e
+
+            pool.apply_async(
+                synthesize_crdt_e2e,
+                args=(
+                    q,
+                    structure,
+                    initState,
+                    grammarStateInvariant,
+                    grammarSupportedCommand,
+                    inOrder,
+                    opPrecondition,
+                    grammar,
+                    grammarQuery,
+                    grammarEquivalence,
+                    targetLang,
+                    synthesize,
+                    useOpList,
+                    stateTypeHint,
+                    opArgTypeHint,
+                    queryArgTypeHint,
+                    queryRetTypeHint,
+                    baseDepth,
+                    filename,
+                    fnNameBase,
+                    loopsFile,
+                    cvcPath,
+                    uid,
+                    resultCache,
+                    budget,
+                    scope,
+                    portfolio,
+                    cegisRounds,
+                    counterexampleBank,
+                ),
+                error_callback=error_callback,
+            )
+
+        if checkpoint is not None:
+            checkpoint.in_flight[uid] = (baseDepth, structure)
+
+    def max_in_flight() -> int:
+        if broker is not None:
+            return max(broker.capacity(), 1)
+        elif concurrency is not None:
+            return concurrency.current
+        else:
+            return maxThreads // 2 if maxThreads > 1 else 1
+
+    pool: Optional[multiprocessing.pool.Pool] = None
+    # enough workers for the most candidates that can be in flight at once
+    pool_size = (
+        concurrency.ceiling
+        if concurrency is not None
+        else maxThreads // 2
+        if maxThreads > 1
+        else 1
+    )
+    # the base depth of the shallowest success so far, for the pool workers
+    depth_limit = mp.Value("i", NO_DEPTH_LIMIT)
+    if broker is not None:
+        broker.begin()
+    elif useProcesses:
+        pool = mp.Pool(
+            pool_size, initializer=_init_candidate_worker, initargs=(depth_limit,)
+        )
+    else:
+        pool = multiprocessing.pool.ThreadPool(pool_size)
+
+    if checkpoint is not None and resuming:
+        # the candidates that are run again get new rows
+        checkpoint.trim_report(reportFile)
 
     try:
-        with multiprocessing.pool.ThreadPool() as pool:
-            with open(reportFile, "w") as report:
+        with open(reportFile, "a" if resuming else "w") as report:
+            while True:
                 while True:
-                    while queue_size < (maxThreads // 2 if maxThreads > 1 else 1) and (
-                        upToUid == None or next_uid < upToUid  # type: ignore
-                    ):
-                        next_structure_tuple = next(structureCandidates, None)
-                        if next_structure_tuple is None:
-                            break
-                        else:
-                            baseDepth, next_structure_type = next_structure_tuple
+                    while shallowest is None and queue_size < max_in_flight():
+                        if resumed:
+                            uid, baseDepth, next_structure_type = resumed.pop(0)
+                        elif upToUid == None or next_uid < upToUid:  # type: ignore
+                            next_structure_tuple = next(candidates, None)
+                            if next_structure_tuple is None:
+                                break
 
-                            def error_callback(e: BaseException) -> None:
-                                raise e
-
-                            try:
-                                synthStateType = ir.TupleT(
-                                    *[a.ir_type() for a in next_structure_type]
-                                )
-                                synthesize_crdt(
-                                    filename,
-                                    fnNameBase,
-                                    loopsFile,
-                                    cvcPath,
-                                    synthStateType,
-                                    lambda: initState(next_structure_type),
-                                    lambda s, baseDepth, invariantBoost: grammarStateInvariant(
-                                        s,
-                                        next_structure_type,
-                                        baseDepth,
-                                        invariantBoost,
-                                    ),
-                                    lambda s, a, baseDepth, invariantBoost: grammarSupportedCommand(
-                                        s,
-                                        a,
-                                        next_structure_type,
-                                        baseDepth,
-                                        invariantBoost,
-                                    ),
-                                    inOrder,
-                                    opPrecondition,
-                                    lambda inState, args, baseDepth: grammar(
-                                        inState,
-                                        args,
-                                        next_structure_type,
-                                        baseDepth,
-                                    ),
-                                    grammarQuery,
-                                    grammarEquivalence,
-                                    targetLang,
-                                    synthesize,
-                                    uid=next_uid,
-                                    useOpList=useOpList,
-                                    stateTypeHint=stateTypeHint,
-                                    opArgTypeHint=opArgTypeHint,
-                                    queryArgTypeHint=queryArgTypeHint,
-                                    queryRetTypeHint=queryRetTypeHint,
-                                    baseDepth=baseDepth,
-                                    log=False,
-                                    skipSynth=True,
-                                )
-                            except KeyError as k:
-                                # this is due to a grammar not being able to find a value
-                                continue
-
-                            print(
-                                f"Enqueueing #{next_uid} (structure: {next_structure_type}, base depth: {baseDepth})"
-                            )
-                            start_times[next_uid] = time()
-                            pool.apply_async(
-                                synthesize_crdt_e2e,
-                                args=(
-                                    q,
-                                    next_structure_type,
-                                    initState,
-                                    grammarStateInvariant,
-                                    grammarSupportedCommand,
-                                    inOrder,
-                                    opPrecondition,
-                                    grammar,
-                                    grammarQuery,
-                                    grammarEquivalence,
-                                    targetLang,
-                                    synthesize,
-                                    useOpList,
-                                    stateTypeHint,
-                                    opArgTypeHint,
-                                    queryArgTypeHint,
-                                    queryRetTypeHint,
-                                    baseDepth,
-                                    filename,
-                                    fnNameBase,
-                                    loopsFile,
-                                    cvcPath,
-                                    next_uid,
-                                ),
-                                error_callback=error_callback,
-                            )
+                            baseDepth, next_structure_type = next_structure_tuple
+                            uid = next_uid
                             next_uid += 1
-                            queue_size += 1
-
-                    if queue_size == 0:
-                        if exitFirstSuccess:
-                            raise Exception("no more structures")
+                            if checkpoint is not None:
+                                checkpoint.next_uid = next_uid
                         else:
                             break
+
+                        enqueue(pool, uid, baseDepth, next_structure_type)
+                        queue_size += 1
+                        if checkpoint is not None:
+                            save_checkpoint()
+
+                    if concurrency is None or broker is not None:
+                        break
+                    # decide with the candidates in flight after refilling, so
+                    # that growing sees the slots that are busy
+                    previous = concurrency.current
+                    if (
+                        concurrency.limit(queue_size) <= previous
+                        or queue_size < previous
+                    ):
+                        break
+
+                if metrics is not None:
+                    metrics.set_in_flight(queue_size, max_in_flight())
+
+                if queue_size == 0:
+                    if exitFirstSuccess:
+                        # the search is over, there is nothing left to resume
+                        if checkpoint is not None:
+                            checkpoint.discard()
+                        raise Exception("no more structures")
                     else:
-                        (ret_uid, next_res_type, baseDepth, next_res) = q.get(
-                            block=True, timeout=None
+                        break
+                else:
+                    if broker is not None:
+                        result = broker.get_result(timeout=1.0)
+                        if result is None:
+                            # workers may have connected or been lost meanwhile
+                            continue
+                    else:
+                        try:
+                            result = q.get(
+                                timeout=concurrency.interval
+                                if concurrency is not None
+                                else None
+                            )
+                        except queue.Empty:
+                            # the load of the host may have changed meanwhile
+                            continue
+                    (
+                        ret_uid,
+                        next_res_type,
+                        baseDepth,
+                        next_res,
+                        outcome,
+                        retries,
+                    ) = result
+                    time_took = time() - start_times[ret_uid]
+                    report.write(
+                        f'{ret_uid},{time_took},"{str(next_res_type)}",{1},{next_res != None},{baseDepth},{outcome},{retries.get("replayed_counterexample", 0)}\n'
+                    )
+                    report.flush()
+                    queue_size -= 1
+                    scopes.pop(ret_uid, None)
+                    depths.pop(ret_uid, None)
+                    if metrics is not None:
+                        metrics.candidate_finished(outcome, retries)
+                        metrics.set_in_flight(queue_size, max_in_flight())
+
+                    if checkpoint is not None:
+                        checkpoint.complete(ret_uid)
+                        save_checkpoint()
+
+                    if isinstance(next_res, str):
+                        raise Exception(
+                            "Synthesis procedure crashed, aborting\n" + next_res
                         )
-                        time_took = time() - start_times[ret_uid]
-                        report.write(
-                            f'{ret_uid},{time_took},"{str(next_res_type)}",{1},{next_res != None}\n'
+                    elif next_res != None:
+                        if exitFirstSuccess and preferShallowest:
+                            if shallowest is None or baseDepth < shallowest[0]:
+                                shallowest = (baseDepth, next_res_type, next_res)
+                            # deeper candidates can no longer win
+                            for uid, scope in scopes.items():
+                                if depths[uid] > shallowest[0]:
+                                    scope.cancel("cancelled")
+                            depth_limit.value = shallowest[0]
+                            if broker is not None:
+                                broker.limit_depth(shallowest[0])
+                        elif exitFirstSuccess:
+                            # stop the solvers of the candidates that lost the race
+                            for scope in scopes.values():
+                                scope.cancel("cancelled")
+                            break
+                    elif outcome == "cancelled":
+                        print(
+                            f"Cancelled #{ret_uid} after a shallower candidate succeeded (structure: {next_res_type}, base depth: {baseDepth})"
                         )
-                        report.flush()
-                        queue_size -= 1
-                        if isinstance(next_res, str):
-                            raise Exception(
-                                "Synthesis procedure crashed, aborting\n" + next_res
-                            )
-                        elif next_res != None:
-                            if exitFirstSuccess:
-                                break
-                        else:
-                            print(
-                                f"Failed to synthesize #{ret_uid} (structure: {next_res_type}, base depth: {baseDepth})"
-                            )
+                    elif outcome == "timeout" or outcome == "oom":
+                        print(
+                            f"Cancelled #{ret_uid} after exceeding its {'time' if outcome == 'timeout' else 'memory'} budget (structure: {next_res_type}, base depth: {baseDepth})"
+                        )
+                    else:
+                        print(
+                            f"Failed to synthesize #{ret_uid} (structure: {next_res_type}, base depth: {baseDepth})"
+                        )
+
+                    if shallowest is not None and all(
+                        depth >= shallowest[0] for depth in depths.values()
+                    ):
+                        # no candidate left in flight can be shallower
+                        for scope in scopes.values():
+                            scope.cancel("cancelled")
+                        _, next_res_type, next_res = shallowest
+                        break
+
+        if checkpoint is not None:
+            checkpoint.discard()
 
         if exitFirstSuccess:
             if next_res == None:
@@ -281,6 +1088,28 @@ def search_crdt_structures(
             print(f"See report file ({reportFile}) for results")
             return (next_res_type, [])
     finally:
+        if broker is not None:
+            # makes the workers cancel the candidates they are still running
+            broker.finish()
+
+        if useProcesses:
+            # the workers kill their solver processes when terminated
+            if pool is not None:
+                pool.terminate()
+            prefilter_pool.terminate()
+        else:
+            # terminating a thread pool waits for the running candidates to
+            # finish, which their cancelled scopes make quick, but there is no
+            # need to hold up the result for it
+            if pool is not None:
+                pool.close()
+                threading.Thread(target=pool.terminate, daemon=True).start()
+            prefilter_pool.close()
+            threading.Thread(target=prefilter_pool.terminate, daemon=True).start()
+
         for p in process_tracker.all_processes:
             p.terminate()
-        process_tracker.all_processes = []
+        del process_tracker.all_processes[:]
+
+        if checkpoint is not None and not checkpoint.finished:
+            save_checkpoint()
@@ -1,6 +1,12 @@
+import functools
 import os
+import queue
+import threading
+import time
+import traceback
+import types
 
-from metalift.analysis_new import VariableTracker, analyze
+from metalift.analysis_new import VariableTracker
 from metalift.ir import *
 
 import typing
@@ -8,6 +14,20 @@ from typing import Callable, Union, Protocol
 
 from metalift.synthesis_common import SynthesisFailed, VerificationFailed
 
+from katara.analysis_cache import analyze
+from katara.candidate_scope import CandidateScope, candidate_scope, current_scope
+from katara.cegis import (
+    CounterexampleBank,
+    CounterexampleFound,
+    check_design,
+    find_counterexample,
+    instantiate,
+    uses_function_arguments,
+    verification_query,
+)
+from katara.result_cache import ResultCache
+from katara import telemetry
+
 
 def observeEquivalence(
     inputState: Expr, synthState: Expr, queryParams: typing.List[Var]
@@ -179,6 +199,84 @@ class SynthesizeFun(Protocol):
         ...
 
 
+def backend_key(synthesize: SynthesizeFun) -> str:
+    """A name for the synthesis backend `synthesize` that is the same in every
+    process, so that outcomes cached for one backend are not replayed for
+    another. Backends other than plain functions must have such a `repr`."""
+    if isinstance(synthesize, types.FunctionType):
+        return f"{synthesize.__module__}.{synthesize.__qualname__}"
+    else:
+        return repr(synthesize)
+
+
+def run_portfolio(
+    uid: int,
+    branches: typing.List[Callable[[], typing.List[FnDecl]]],
+    tolerateCrashes: bool = False,
+) -> typing.List[FnDecl]:
+    """Run alternative ways of synthesizing a candidate concurrently, each in
+    a child of the current `CandidateScope`, and return the result of the first
+    one to succeed after cancelling the others.
+
+    A branch that crashes aborts the portfolio, unless `tolerateCrashes` is
+    set, in which case the crash is only raised if no branch succeeds. If no
+    branch succeeds and one of them failed verification, the first such
+    `VerificationFailed` is raised, so that the caller can escalate bounds."""
+    parent = current_scope()
+    results: queue.Queue[
+        typing.Tuple[
+            typing.Optional[typing.List[FnDecl]],
+            typing.Optional[str],
+            typing.Optional[VerificationFailed],
+        ]
+    ] = queue.Queue()
+
+    def run(branch: Callable[[], typing.List[FnDecl]], scope: CandidateScope) -> None:
+        try:
+            with candidate_scope(scope):
+                results.put((branch(), None, None))
+        except SynthesisFailed:
+            results.put((None, None, None))
+        except VerificationFailed as e:
+            results.put((None, None, e))
+        except:
+            if scope.cancelled is not None:
+                results.put((None, None, None))
+            else:
+                results.put((None, traceback.format_exc(), None))
+
+    scopes = [
+        parent.child() if parent is not None else CandidateScope(uid) for _ in branches
+    ]
+    for branch, scope in zip(branches, scopes):
+        threading.Thread(target=run, args=(branch, scope), daemon=True).start()
+
+    try:
+        first_crash = None
+        first_verification_failure = None
+        for _ in branches:
+            out, crash, verification_failure = results.get()
+            if out is not None:
+                return out
+            elif verification_failure is not None:
+                first_verification_failure = (
+                    first_verification_failure or verification_failure
+                )
+            elif crash is not None:
+                if not tolerateCrashes:
+                    raise Exception(f"#{uid}: portfolio branch crashed\n" + crash)
+                print(f"#{uid}: portfolio branch crashed\n" + crash)
+                first_crash = first_crash or crash
+        if first_verification_failure is not None:
+            raise first_verification_failure
+        if first_crash is not None:
+            raise Exception(f"#{uid}: portfolio branch crashed\n" + first_crash)
+        raise SynthesisFailed(f"#{uid}: all portfolio branches failed")
+    finally:
+        for scope in scopes:
+            scope.cancel("cancelled")
+
+
 def synthesize_crdt(
     filename: str,
     fnNameBase: str,
@@ -207,22 +305,45 @@ def synthesize_crdt(
     invariantBoost: int = 0,
     log: bool = True,
     skipSynth: bool = False,
+    resultCache: typing.Optional[ResultCache] = None,
+    retryReason: typing.Optional[str] = None,
+    logSuffix: str = "",
+    portfolio: bool = False,
+    cegisRounds: int = 0,
+    counterexamples: typing.Optional[typing.List[typing.Dict[str, Expr]]] = None,
+    counterexampleBank: typing.Optional[CounterexampleBank] = None,
+    counterexampleTimeLimit: int = 100000,
 ) -> typing.List[FnDecl]:
-    basename = os.path.splitext(os.path.basename(filename))[0]
+    basename = os.path.splitext(os.path.basename(filename))[0] + logSuffix
+    counterexamples = counterexamples or []
+
+    scope = current_scope()
+    if scope is not None and retryReason is not None:
+        scope.count_retry(retryReason)
+
+    spanFields = {
+        "uid": uid,
+        "listBound": listBound,
+        "invariantBoost": invariantBoost,
+        "baseDepth": baseDepth,
+        "useOpList": useOpList,
+        "retryReason": retryReason,
+    }
 
     tracker = VariableTracker()
 
-    state_transition_analysis = analyze(
-        filename,
-        fnNameBase + "_next_state",
-        loopsFile,
-    )
+    with telemetry.span("analysis", **spanFields):
+        state_transition_analysis = analyze(
+            filename,
+            fnNameBase + "_next_state",
+            loopsFile,
+        )
 
-    query_analysis = analyze(
-        filename,
-        fnNameBase + "_response",
-        loopsFile,
-    )
+        query_analysis = analyze(
+            filename,
+            fnNameBase + "_response",
+            loopsFile,
+        )
 
     origSynthStateType = synthStateType
 
@@ -269,309 +390,331 @@ def synthesize_crdt(
             ),
         )
 
-    seq_start_state = tracker.variable(
-        "seq_start_state", state_transition_analysis.arguments[0].type
-    )
-    synth_start_state = tracker.variable("synth_start_state", synthStateType)
-    equivalence_query_vars = [
-        tracker.variable(
-            f"start_state_query_var_{i}", query_analysis.arguments[i + 1].type
+    with telemetry.span("vc", **spanFields):
+        seq_start_state = tracker.variable(
+            "seq_start_state", state_transition_analysis.arguments[0].type
         )
-        for i in range(len(query_analysis.arguments) - 1)
-    ]
+        synth_start_state = tracker.variable("synth_start_state", synthStateType)
+        equivalence_query_vars = [
+            tracker.variable(
+                f"start_state_query_var_{i}", query_analysis.arguments[i + 1].type
+            )
+            for i in range(len(query_analysis.arguments) - 1)
+        ]
 
-    synth_after_op = tracker.variable("synth_after_op", synthStateType)
+        synth_after_op = tracker.variable("synth_after_op", synthStateType)
 
-    first_op_group = tracker.group("first_op")
-    first_op_args = [
-        first_op_group.variable(v.name(), t)
-        for v, t in zip(state_transition_analysis.arguments[1:], op_arg_types)
-    ]
+        first_op_group = tracker.group("first_op")
+        first_op_args = [
+            first_op_group.variable(v.name(), t)
+            for v, t in zip(state_transition_analysis.arguments[1:], op_arg_types)
+        ]
 
-    second_op_group = tracker.group("second_op")
-    second_op_args = [
-        second_op_group.variable(v.name(), t)
-        for v, t in zip(state_transition_analysis.arguments[1:], op_arg_types)
-    ]
+        second_op_group = tracker.group("second_op")
+        second_op_args = [
+            second_op_group.variable(v.name(), t)
+            for v, t in zip(state_transition_analysis.arguments[1:], op_arg_types)
+        ]
 
-    vcStateTransition = state_transition_analysis.call(seq_start_state, *first_op_args)(
-        tracker,
-        lambda seq_after_op: Implies(
-            And(
-                observeEquivalence(
-                    seq_start_state, synth_start_state, equivalence_query_vars
-                ),
-                *(
-                    [
-                        opsListInvariant(
-                            fnNameBase, synth_start_state, synthStateType, opType
-                        ),
-                        supportedCommandWithList(synth_start_state, first_op_args),
-                    ]
-                    if useOpList
-                    else [
-                        opPrecondition(first_op_args),
-                        supportedCommand(synth_start_state, first_op_args),
-                    ]
-                ),
-                Eq(
-                    synth_after_op,
-                    Call(
-                        f"{fnNameBase}_next_state",
-                        synthStateType,
-                        synth_start_state,
-                        *first_op_args,
+        vcStateTransition = state_transition_analysis.call(
+            seq_start_state, *first_op_args
+        )(
+            tracker,
+            lambda seq_after_op: Implies(
+                And(
+                    observeEquivalence(
+                        seq_start_state, synth_start_state, equivalence_query_vars
+                    ),
+                    *(
+                        [
+                            opsListInvariant(
+                                fnNameBase, synth_start_state, synthStateType, opType
+                            ),
+                            supportedCommandWithList(synth_start_state, first_op_args),
+                        ]
+                        if useOpList
+                        else [
+                            opPrecondition(first_op_args),
+                            supportedCommand(synth_start_state, first_op_args),
+                        ]
                     ),
-                ),
-            ),
-            query_analysis.call(seq_start_state, *equivalence_query_vars)(
-                tracker,
-                lambda seqQueryResult: Implies(
                     Eq(
-                        seqQueryResult,
+                        synth_after_op,
                         Call(
-                            f"{fnNameBase}_response",
-                            seqQueryResult.type,
+                            f"{fnNameBase}_next_state",
+                            synthStateType,
                             synth_start_state,
-                            *equivalence_query_vars,
+                            *first_op_args,
                         ),
                     ),
-                    And(
-                        observeEquivalence(
-                            seq_after_op, synth_after_op, equivalence_query_vars
-                        ),
-                        query_analysis.call(seq_after_op, *equivalence_query_vars)(
-                            tracker,
-                            lambda seqQueryResult: Eq(
-                                seqQueryResult,
-                                Call(
-                                    f"{fnNameBase}_response",
-                                    seqQueryResult.type,
-                                    synth_after_op,
-                                    *equivalence_query_vars,
-                                ),
+                ),
+                query_analysis.call(seq_start_state, *equivalence_query_vars)(
+                    tracker,
+                    lambda seqQueryResult: Implies(
+                        Eq(
+                            seqQueryResult,
+                            Call(
+                                f"{fnNameBase}_response",
+                                seqQueryResult.type,
+                                synth_start_state,
+                                *equivalence_query_vars,
                             ),
                         ),
-                        *(
-                            [
-                                Implies(
-                                    And(
-                                        inOrder(first_op_args, second_op_args),
-                                        opPrecondition(second_op_args),
+                        And(
+                            observeEquivalence(
+                                seq_after_op, synth_after_op, equivalence_query_vars
+                            ),
+                            query_analysis.call(seq_after_op, *equivalence_query_vars)(
+                                tracker,
+                                lambda seqQueryResult: Eq(
+                                    seqQueryResult,
+                                    Call(
+                                        f"{fnNameBase}_response",
+                                        seqQueryResult.type,
+                                        synth_after_op,
+                                        *equivalence_query_vars,
                                     ),
-                                    supportedCommand(synth_after_op, second_op_args),
-                                )
-                            ]
-                            if not useOpList
-                            else []
+                                ),
+                            ),
+                            *(
+                                [
+                                    Implies(
+                                        And(
+                                            inOrder(first_op_args, second_op_args),
+                                            opPrecondition(second_op_args),
+                                        ),
+                                        supportedCommand(
+                                            synth_after_op, second_op_args
+                                        ),
+                                    )
+                                ]
+                                if not useOpList
+                                else []
+                            ),
                         ),
                     ),
                 ),
             ),
-        ),
-    )
+        )
 
-    # define synthesis problem for state transition
-    cur_state_param = Var("cur_state", synthStateType)
+    with telemetry.span("grammar", **spanFields):
+        # define synthesis problem for state transition
+        cur_state_param = Var("cur_state", synthStateType)
 
-    op_arg_vars = [
-        Var(v.name(), t)
-        for v, t in zip(state_transition_analysis.arguments[1:], op_arg_types)
-    ]
+        op_arg_vars = [
+            Var(v.name(), t)
+            for v, t in zip(state_transition_analysis.arguments[1:], op_arg_types)
+        ]
 
-    stateTransitionSynthNode = grammar(
-        cur_state_param,
-        op_arg_vars,
-        baseDepth,
-    )
+        stateTransitionSynthNode = grammar(
+            cur_state_param,
+            op_arg_vars,
+            baseDepth,
+        )
 
-    invAndPsStateTransition = (
-        [
-            Synth(
-                fnNameBase + "_next_state",
-                Tuple(
-                    # the grammar directly produces the tupled next state, unpack to tack on the op-list
-                    *stateTransitionSynthNode.args,
-                    Call(
-                        "list_prepend",
-                        ListT(opType),
-                        Tuple(*op_arg_vars) if len(op_arg_vars) > 1 else op_arg_vars[0],
-                        TupleGet(
-                            cur_state_param,
-                            IntLit(len(synthStateType.args) - 1),
+        invAndPsStateTransition = (
+            [
+                Synth(
+                    fnNameBase + "_next_state",
+                    Tuple(
+                        # the grammar directly produces the tupled next state, unpack to tack on the op-list
+                        *stateTransitionSynthNode.args,
+                        Call(
+                            "list_prepend",
+                            ListT(opType),
+                            Tuple(*op_arg_vars)
+                            if len(op_arg_vars) > 1
+                            else op_arg_vars[0],
+                            TupleGet(
+                                cur_state_param,
+                                IntLit(len(synthStateType.args) - 1),
+                            ),
                         ),
                     ),
+                    cur_state_param,
+                    *op_arg_vars,
+                )
+            ]
+            if useOpList
+            else [
+                Synth(
+                    fnNameBase + "_next_state",
+                    stateTransitionSynthNode,
+                    cur_state_param,
+                    *op_arg_vars,
+                )
+            ]
+        )
+        # end state transition (in order)
+
+        # begin query
+        invAndPsQuery = [
+            grammarQuery(
+                query_analysis.name,
+                [Var(query_analysis.arguments[0].name(), synthStateType)]
+                + (
+                    [
+                        Var(query_analysis.arguments[i + 1].name(), queryArgTypeHint[i])
+                        for i in range(len(queryArgTypeHint))
+                    ]
+                    if queryArgTypeHint
+                    else query_analysis.arguments[1:]
                 ),
-                cur_state_param,
-                *op_arg_vars,
+                query_analysis.return_type
+                if queryRetTypeHint is None
+                else queryRetTypeHint,
+                baseDepth,
             )
         ]
-        if useOpList
-        else [
-            Synth(
-                fnNameBase + "_next_state",
-                stateTransitionSynthNode,
-                cur_state_param,
-                *op_arg_vars,
-            )
-        ]
-    )
-    # end state transition (in order)
-
-    # begin query
-    invAndPsQuery = [
-        grammarQuery(
-            query_analysis.name,
-            [Var(query_analysis.arguments[0].name(), synthStateType)]
-            + (
-                [
-                    Var(query_analysis.arguments[i + 1].name(), queryArgTypeHint[i])
-                    for i in range(len(queryArgTypeHint))
-                ]
-                if queryArgTypeHint
-                else query_analysis.arguments[1:]
-            ),
-            query_analysis.return_type
-            if queryRetTypeHint is None
-            else queryRetTypeHint,
-            baseDepth,
-        )
-    ]
-    # end query
+        # end query
 
     # begin init state
-    initState_analysis = analyze(
-        filename,
-        fnNameBase + "_init_state",
-        loopsFile,
-    )
+    with telemetry.span("analysis", **spanFields):
+        initState_analysis = analyze(
+            filename,
+            fnNameBase + "_init_state",
+            loopsFile,
+        )
 
-    synthInitState = tracker.variable("synth_init_state", synthStateType)
+    with telemetry.span("vc", **spanFields):
+        synthInitState = tracker.variable("synth_init_state", synthStateType)
 
-    init_op_arg_vars = []
-    for i, typ in enumerate(op_arg_types):
-        init_op_arg_vars.append(tracker.variable(f"init_op_arg_{i}", typ))
+        init_op_arg_vars = []
+        for i, typ in enumerate(op_arg_types):
+            init_op_arg_vars.append(tracker.variable(f"init_op_arg_{i}", typ))
 
-    queryParamVars = [
-        tracker.variable(
-            f"init_state_equivalence_query_param_{i}",
-            query_analysis.arguments[i + 1].type,
-        )
-        for i in range(len(query_analysis.arguments) - 1)
-    ]
+        queryParamVars = [
+            tracker.variable(
+                f"init_state_equivalence_query_param_{i}",
+                query_analysis.arguments[i + 1].type,
+            )
+            for i in range(len(query_analysis.arguments) - 1)
+        ]
 
-    vcInitState = initState_analysis.call()(
-        tracker,
-        lambda seqInitialState: Implies(
-            Eq(synthInitState, Call(f"{fnNameBase}_init_state", synthStateType)),
-            And(
-                observeEquivalence(seqInitialState, synthInitState, queryParamVars),
-                query_analysis.call(seqInitialState, *queryParamVars)(
-                    tracker,
-                    lambda seqQueryResult: Eq(
-                        seqQueryResult,
-                        Call(
-                            f"{fnNameBase}_response",
-                            seqQueryResult.type,
-                            synthInitState,
-                            *queryParamVars,
+        vcInitState = initState_analysis.call()(
+            tracker,
+            lambda seqInitialState: Implies(
+                Eq(synthInitState, Call(f"{fnNameBase}_init_state", synthStateType)),
+                And(
+                    observeEquivalence(seqInitialState, synthInitState, queryParamVars),
+                    query_analysis.call(seqInitialState, *queryParamVars)(
+                        tracker,
+                        lambda seqQueryResult: Eq(
+                            seqQueryResult,
+                            Call(
+                                f"{fnNameBase}_response",
+                                seqQueryResult.type,
+                                synthInitState,
+                                *queryParamVars,
+                            ),
                         ),
                     ),
-                ),
-                BoolLit(True)
-                if useOpList
-                else Implies(
-                    opPrecondition(init_op_arg_vars),
-                    supportedCommand(synthInitState, init_op_arg_vars),
+                    BoolLit(True)
+                    if useOpList
+                    else Implies(
+                        opPrecondition(init_op_arg_vars),
+                        supportedCommand(synthInitState, init_op_arg_vars),
+                    ),
                 ),
             ),
-        ),
-    )
-
-    initStateSynthNode = initState()
-    invAndPsInitState = [
-        Synth(
-            fnNameBase + "_init_state",
-            Tuple(
-                *initStateSynthNode.args,
-                Call("list_empty", ListT(opType)),
-            )
-            if useOpList
-            else Tuple(
-                *initStateSynthNode.args,
-            ),
         )
-    ]
-    # end init state
-
-    # begin equivalence
-    inputStateForEquivalence = Var(
-        "inputState",
-        state_transition_analysis.arguments[0].type
-        if stateTypeHint is None
-        else stateTypeHint,
-    )
-    synthStateForEquivalence = Var("synthState", synthStateType)
 
-    equivalenceQueryParams = [
-        Var(f"equivalence_query_param_{i}", queryParameterTypes[i])
-        for i in range(len(queryParameterTypes))
-    ]
-
-    invAndPsEquivalence = [
-        Synth(
-            "equivalence",
-            And(
-                grammarEquivalence(
-                    inputStateForEquivalence,
-                    synthStateForEquivalence,
-                    equivalenceQueryParams,
-                    baseDepth,
-                ),
-                *(
-                    [
-                        grammarStateInvariant(
-                            synthStateForEquivalence, baseDepth, invariantBoost
-                        )
-                    ]
-                    if not useOpList
-                    else []
+    with telemetry.span("grammar", **spanFields):
+        initStateSynthNode = initState()
+        invAndPsInitState = [
+            Synth(
+                fnNameBase + "_init_state",
+                Tuple(
+                    *initStateSynthNode.args,
+                    Call("list_empty", ListT(opType)),
+                )
+                if useOpList
+                else Tuple(
+                    *initStateSynthNode.args,
                 ),
-            ),
-            inputStateForEquivalence,
-            synthStateForEquivalence,
-            *equivalenceQueryParams,
+            )
+        ]
+        # end init state
+
+        # begin equivalence
+        inputStateForEquivalence = Var(
+            "inputState",
+            state_transition_analysis.arguments[0].type
+            if stateTypeHint is None
+            else stateTypeHint,
         )
-    ]
+        synthStateForEquivalence = Var("synthState", synthStateType)
 
-    synthStateForSupported = Var(f"supported_synthState", synthStateType)
-    argList = [
-        Var(
-            f"supported_arg_{i}",
-            op_arg_types[i],
-        )
-        for i in range(len(op_arg_types))
-    ]
-    invAndPsSupported = (
-        [
+        equivalenceQueryParams = [
+            Var(f"equivalence_query_param_{i}", queryParameterTypes[i])
+            for i in range(len(queryParameterTypes))
+        ]
+
+        invAndPsEquivalence = [
             Synth(
-                "supportedCommand",
-                grammarSupportedCommand(
-                    synthStateForSupported, argList, baseDepth, invariantBoost
+                "equivalence",
+                And(
+                    grammarEquivalence(
+                        inputStateForEquivalence,
+                        synthStateForEquivalence,
+                        equivalenceQueryParams,
+                        baseDepth,
+                    ),
+                    *(
+                        [
+                            grammarStateInvariant(
+                                synthStateForEquivalence, baseDepth, invariantBoost
+                            )
+                        ]
+                        if not useOpList
+                        else []
+                    ),
                 ),
-                synthStateForSupported,
-                *argList,
+                inputStateForEquivalence,
+                synthStateForEquivalence,
+                *equivalenceQueryParams,
             )
         ]
-        if not useOpList
-        else []
-    )
-    # end equivalence
+
+        synthStateForSupported = Var(f"supported_synthState", synthStateType)
+        argList = [
+            Var(
+                f"supported_arg_{i}",
+                op_arg_types[i],
+            )
+            for i in range(len(op_arg_types))
+        ]
+        invAndPsSupported = (
+            [
+                Synth(
+                    "supportedCommand",
+                    grammarSupportedCommand(
+                        synthStateForSupported, argList, baseDepth, invariantBoost
+                    ),
+                    synthStateForSupported,
+                    *argList,
+                )
+            ]
+            if not useOpList
+            else []
+        )
+        # end equivalence
 
     if log:
         print("====== synthesis")
 
     combinedVCVars = set(tracker.all())
+    # the variables the VC holds for all values of, which a counterexample
+    # assigns
+    vcInputs = {
+        seq_start_state,
+        synth_start_state,
+        *equivalence_query_vars,
+        *first_op_args,
+        *second_op_args,
+        *init_op_arg_vars,
+        *queryParamVars,
+    }
 
     combinedInvAndPs = (
         invAndPsStateTransition
@@ -581,7 +724,26 @@ def synthesize_crdt(
         + invAndPsSupported
     )
 
-    combinedVC = And(vcStateTransition, vcInitState)
+    baseVC = And(vcStateTransition, vcInitState)
+    if counterexampleBank is not None:
+        bankKey = counterexampleBank.problem_key(filename, fnNameBase, combinedVCVars)
+        seeded = (
+            counterexampleBank.entries(bankKey, counterexampleBank.seedLimit)
+            if counterexampleBank.seed
+            else []
+        )
+    else:
+        seeded = []
+    # the VC must also hold on the counterexamples to earlier designs, even if
+    # they are beyond the bounds Rosette checks
+    combinedVC = (
+        And(
+            baseVC,
+            *[instantiate(baseVC, c, vcInputs) for c in counterexamples + seeded],
+        )
+        if counterexamples or seeded
+        else baseVC
+    )
 
     lang = targetLang()
     if useOpList:
@@ -592,23 +754,167 @@ def synthesize_crdt(
     if skipSynth:
         return  # type: ignore
 
+    if scope is not None and scope.cancelled is not None:
+        raise SynthesisFailed(f"#{uid}: cancelled ({scope.cancelled})")
+
+    # read a counterexample back from CVC5 if the design fails to verify
+    findCounterexample = not useOpList and (
+        cegisRounds > 0 or counterexampleBank is not None
+    )
+
+    # replaying banked counterexamples needs the design before it is verified,
+    # so the design is then verified here rather than by metalift, which is
+    # only possible if the query needs none of the function argument
+    # specializations metalift makes
+    replay = (
+        findCounterexample
+        and counterexampleBank is not None
+        and not uses_function_arguments([*lang, *combinedInvAndPs, combinedVC])
+    )
+
+    def runSynthesis() -> typing.List[FnDecl]:
+        started = time.time()
+        try:
+            out = synthesize(
+                basename,
+                lang,
+                combinedVCVars,
+                combinedInvAndPs,
+                [],
+                combinedVC,
+                [*combinedInvAndPs],
+                cvcPath,
+                uid=uid,
+                unboundedInts=unboundedInts,
+                noVerify=useOpList or replay,
+                listBound=listBound,
+                log=log,
+            )
+        except VerificationFailed:
+            if not findCounterexample:
+                raise
+            with telemetry.span("cegis", **spanFields) as record:
+                smtFile = verification_query(basename, uid, started)
+                counterexample = (
+                    find_counterexample(
+                        smtFile, vcInputs, cvcPath, counterexampleTimeLimit
+                    )
+                    if smtFile is not None
+                    else None
+                )
+                record["found"] = counterexample is not None
+            if counterexample is None:
+                raise
+            if counterexampleBank is not None:
+                counterexampleBank.add(bankKey, counterexample)
+            raise CounterexampleFound(counterexample)
+
+        if replay:
+            assert counterexampleBank is not None
+            with telemetry.span("replay", **spanFields) as record:
+                counterexample = counterexampleBank.replay(
+                    bankKey,
+                    basename,
+                    uid,
+                    lang,
+                    out,
+                    combinedVCVars,
+                    vcInputs,
+                    baseVC,
+                    cvcPath,
+                    counterexampleTimeLimit,
+                )
+                record["hit"] = counterexample is not None
+            if counterexample is not None:
+                raise CounterexampleFound(counterexample, replayed=True)
+
+            with telemetry.span("cegis", **spanFields) as record:
+                result, counterexample = check_design(
+                    f"synthesisLogs/cegis_{basename}_{uid}.smt",
+                    lang,
+                    out,
+                    combinedVCVars,
+                    vcInputs,
+                    combinedVC,
+                    cvcPath,
+                    counterexampleTimeLimit,
+                )
+                record["found"] = counterexample is not None
+            if counterexample is not None:
+                counterexampleBank.add(bankKey, counterexample)
+                raise CounterexampleFound(counterexample)
+            elif result != "unsat":
+                raise VerificationFailed(
+                    f"#{uid}: CVC5 could not verify the synthesized design ({result})"
+                )
+        return out
+
     try:
-        out = synthesize(
-            basename,
-            lang,
-            combinedVCVars,
-            combinedInvAndPs,
-            [],
-            combinedVC,
-            [*combinedInvAndPs],
-            cvcPath,
-            uid=uid,
-            unboundedInts=unboundedInts,
-            noVerify=useOpList,
-            listBound=listBound,
-            log=log,
-        )
-    except VerificationFailed:
+        with telemetry.span("solve", **spanFields):
+            if resultCache is not None:
+                out = resultCache.run(
+                    resultCache.problem_key(
+                        filename,
+                        loopsFile,
+                        synthStateType,
+                        lang,
+                        sorted(combinedVCVars, key=repr),
+                        combinedInvAndPs,
+                        combinedVC,
+                        unboundedInts=unboundedInts,
+                        useOpList=useOpList,
+                        listBound=listBound,
+                        baseDepth=baseDepth,
+                        invariantBoost=invariantBoost,
+                        backend=backend_key(synthesize),
+                    ),
+                    runSynthesis,
+                )
+            else:
+                out = runSynthesis()
+    except VerificationFailed as e:
+        replayed = isinstance(e, CounterexampleFound) and e.replayed
+        if isinstance(e, CounterexampleFound) and e.assignment and cegisRounds > 0:
+            print(
+                f"#{uid}: CVC5 found a counterexample to the synthesized design, re-synthesizing with it at the same bounds"
+            )
+            return synthesize_crdt(
+                filename,
+                fnNameBase,
+                loopsFile,
+                cvcPath,
+                origSynthStateType,
+                initState,
+                grammarStateInvariant,
+                grammarSupportedCommand,
+                inOrder,
+                opPrecondition,
+                grammar,
+                grammarQuery,
+                grammarEquivalence,
+                targetLang,
+                synthesize,
+                stateTypeHint=stateTypeHint,
+                opArgTypeHint=opArgTypeHint,
+                queryArgTypeHint=queryArgTypeHint,
+                queryRetTypeHint=queryRetTypeHint,
+                uid=uid,
+                unboundedInts=unboundedInts,
+                useOpList=useOpList,
+                listBound=listBound,
+                baseDepth=baseDepth,
+                invariantBoost=invariantBoost,
+                log=log,
+                resultCache=resultCache,
+                retryReason="replayed_counterexample" if replayed else "counterexample",
+                logSuffix=logSuffix,
+                portfolio=portfolio,
+                cegisRounds=cegisRounds - 1,
+                counterexamples=counterexamples + [e.assignment],
+                counterexampleBank=counterexampleBank,
+                counterexampleTimeLimit=counterexampleTimeLimit,
+            )
+
         # direct synthesis mode
         print(
             f"#{uid}: CVC5 failed to verify synthesized design, increasing Rosette data structure bounds to",
@@ -641,6 +947,16 @@ def synthesize_crdt(
             baseDepth=baseDepth,
             invariantBoost=invariantBoost,
             log=log,
+            resultCache=resultCache,
+            retryReason="replayed_counterexample"
+            if replayed
+            else "verification_failed",
+            logSuffix=logSuffix,
+            portfolio=portfolio,
+            cegisRounds=cegisRounds,
+            counterexamples=counterexamples,
+            counterexampleBank=counterexampleBank,
+            counterexampleTimeLimit=counterexampleTimeLimit,
         )
 
     if useOpList:
@@ -688,7 +1004,7 @@ def synthesize_crdt(
 
         init_state_fn.args[1] = Tuple(*init_state_fn.args[1].args[:-1])
 
-        try:
+        def synthesizeInvariants(branchSuffix: str) -> typing.List[FnDecl]:
             # attempt to synthesize the invariants
             return synthesize_crdt(
                 filename,
@@ -726,83 +1042,115 @@ def synthesize_crdt(
                 baseDepth=baseDepth,
                 invariantBoost=invariantBoost,
                 log=log,
+                resultCache=resultCache,
+                retryReason="invariants",
+                logSuffix=logSuffix + branchSuffix,
+                cegisRounds=cegisRounds,
+                counterexampleBank=counterexampleBank,
+                counterexampleTimeLimit=counterexampleTimeLimit,
             )
-        except SynthesisFailed:
-            try:
-                # try to re-verify with a larger bound
-                print(
-                    f"#{uid}: re-verifying with history bound {listBound + 1} and attempting to re-synthesize invariants with deeper grammar"
-                )
-                return synthesize_crdt(
-                    filename,
-                    fnNameBase,
-                    loopsFile,
-                    cvcPath,
-                    origSynthStateType,
-                    lambda: init_state_fn.args[1],  # type: ignore
-                    grammarStateInvariant,
-                    grammarSupportedCommand,
-                    inOrder,
-                    opPrecondition,
-                    lambda inState, args, _baseDepth: typing.cast(
-                        Expr, state_transition_fn.args[1]
-                    ).rewrite(
-                        {
-                            cur_state_param.name(): inState,
-                            **{
-                                orig.name(): new for orig, new in zip(op_arg_vars, args)
-                            },
-                        }
-                    ),
-                    lambda _name, args, _retT, _baseDepth: Synth(
-                        query_fn.args[0], query_fn.args[1], *args
-                    ),
-                    lambda a, b, c, _baseDepth: equivalence_fn.args[1],  # type: ignore
-                    targetLang,
-                    synthesize,
-                    stateTypeHint=stateTypeHint,
-                    opArgTypeHint=opArgTypeHint,
-                    queryArgTypeHint=queryArgTypeHint,
-                    queryRetTypeHint=queryRetTypeHint,
-                    uid=uid,
-                    unboundedInts=unboundedInts,
-                    useOpList=useOpList,
-                    listBound=listBound + 1,
-                    baseDepth=baseDepth,
-                    invariantBoost=invariantBoost + 1,
-                    log=log,
-                )
-            except SynthesisFailed:
-                print(
-                    f"#{uid}: could not synthesize invariants, re-synthesizing entire design with history bound {listBound + 1}"
-                )
-                return synthesize_crdt(
-                    filename,
-                    fnNameBase,
-                    loopsFile,
-                    cvcPath,
-                    origSynthStateType,
-                    initState,
-                    grammarStateInvariant,
-                    grammarSupportedCommand,
-                    inOrder,
-                    opPrecondition,
-                    grammar,
-                    grammarQuery,
-                    grammarEquivalence,
-                    targetLang,
-                    synthesize,
-                    stateTypeHint=stateTypeHint,
-                    opArgTypeHint=opArgTypeHint,
-                    queryArgTypeHint=queryArgTypeHint,
-                    queryRetTypeHint=queryRetTypeHint,
-                    uid=uid,
-                    unboundedInts=unboundedInts,
-                    useOpList=useOpList,
-                    listBound=listBound + 1,
-                    baseDepth=baseDepth,
-                    invariantBoost=invariantBoost,
-                    log=log,
-                )
+
+        def reverifyDeeper(branchSuffix: str) -> typing.List[FnDecl]:
+            # try to re-verify with a larger bound
+            print(
+                f"#{uid}: re-verifying with history bound {listBound + 1} and attempting to re-synthesize invariants with deeper grammar"
+            )
+            return synthesize_crdt(
+                filename,
+                fnNameBase,
+                loopsFile,
+                cvcPath,
+                origSynthStateType,
+                lambda: init_state_fn.args[1],  # type: ignore
+                grammarStateInvariant,
+                grammarSupportedCommand,
+                inOrder,
+                opPrecondition,
+                lambda inState, args, _baseDepth: typing.cast(
+                    Expr, state_transition_fn.args[1]
+                ).rewrite(
+                    {
+                        cur_state_param.name(): inState,
+                        **{orig.name(): new for orig, new in zip(op_arg_vars, args)},
+                    }
+                ),
+                lambda _name, args, _retT, _baseDepth: Synth(
+                    query_fn.args[0], query_fn.args[1], *args
+                ),
+                lambda a, b, c, _baseDepth: equivalence_fn.args[1],  # type: ignore
+                targetLang,
+                synthesize,
+                stateTypeHint=stateTypeHint,
+                opArgTypeHint=opArgTypeHint,
+                queryArgTypeHint=queryArgTypeHint,
+                queryRetTypeHint=queryRetTypeHint,
+                uid=uid,
+                unboundedInts=unboundedInts,
+                useOpList=useOpList,
+                listBound=listBound + 1,
+                baseDepth=baseDepth,
+                invariantBoost=invariantBoost + 1,
+                log=log,
+                resultCache=resultCache,
+                retryReason="invariants_deeper",
+                logSuffix=logSuffix + branchSuffix,
+                cegisRounds=cegisRounds,
+                counterexampleBank=counterexampleBank,
+                counterexampleTimeLimit=counterexampleTimeLimit,
+            )
+
+        def resynthesize(branchSuffix: str) -> typing.List[FnDecl]:
+            print(
+                f"#{uid}: could not synthesize invariants, re-synthesizing entire design with history bound {listBound + 1}"
+            )
+            return synthesize_crdt(
+                filename,
+                fnNameBase,
+                loopsFile,
+                cvcPath,
+                origSynthStateType,
+                initState,
+                grammarStateInvariant,
+                grammarSupportedCommand,
+                inOrder,
+                opPrecondition,
+                grammar,
+                grammarQuery,
+                grammarEquivalence,
+                targetLang,
+                synthesize,
+                stateTypeHint=stateTypeHint,
+                opArgTypeHint=opArgTypeHint,
+                queryArgTypeHint=queryArgTypeHint,
+                queryRetTypeHint=queryRetTypeHint,
+                uid=uid,
+                unboundedInts=unboundedInts,
+                useOpList=useOpList,
+                listBound=listBound + 1,
+                baseDepth=baseDepth,
+                invariantBoost=invariantBoost,
+                log=log,
+                resultCache=resultCache,
+                retryReason="resynthesize",
+                logSuffix=logSuffix + branchSuffix,
+                cegisRounds=cegisRounds,
+                counterexampleBank=counterexampleBank,
+                counterexampleTimeLimit=counterexampleTimeLimit,
+            )
+
+        ladder = [synthesizeInvariants, reverifyDeeper, resynthesize]
+        if portfolio:
+            # the branches log to different files
+            return run_portfolio(
+                uid,
+                [functools.partial(step, f"_p{i}") for i, step in enumerate(ladder)],
+            )
+        else:
+            for step in ladder[:-1]:
+                try:
+                    return step("")
+                except SynthesisFailed:
+                    pass
+            return ladder[-1]("")
     else:
         return out
@@ -0,0 +1,76 @@
+import contextlib
+import json
+import os
+import threading
+from time import time
+import typing
+
+# set in the environment so that worker processes inherit it
+TELEMETRY_ENV = "KATARA_TELEMETRY"
+
+_path: typing.Optional[str] = os.environ.get(TELEMETRY_ENV) or None
+_fd: typing.Optional[int] = None
+_lock = threading.Lock()
+
+
+def configure(path: typing.Optional[str]) -> None:
+    """Append a JSON record for every span to `path` from now on, in this
+    process and in the processes it starts, or stop recording with `None`."""
+    global _path, _fd
+    with _lock:
+        if _fd is not None:
+            os.close(_fd)
+            _fd = None
+        _path = path
+    if path is None:
+        os.environ.pop(TELEMETRY_ENV, None)
+    else:
+        os.environ[TELEMETRY_ENV] = path
+
+
+def enabled() -> bool:
+    return _path is not None
+
+
+def _write(record: typing.Dict[str, typing.Any]) -> None:
+    global _fd
+    line = (json.dumps(record, default=str) + "\n").encode("utf-8")
+    with _lock:
+        if _fd is None:
+            assert _path is not None
+            _fd = os.open(_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        # a single write to a file opened for appending is not interleaved
+        # with those of other processes
+        os.write(_fd, line)
+
+
+@contextlib.contextmanager
+def span(
+    phase: str, **fields: typing.Any
+) -> typing.Iterator[typing.Dict[str, typing.Any]]:
+    """Record the duration of the enclosed block as a `phase` span, along with
+    `fields` and any fields added to the yielded dict inside the block. The
+    status of the span is the name of the exception that left the block, if
+    any. Does nothing when telemetry is disabled."""
+    if _path is None:
+        yield fields
+        return
+
+    start = time()
+    status = "ok"
+    try:
+        yield fields
+    except BaseException as e:
+        status = type(e).__name__
+        raise
+    finally:
+        _write(
+            {
+                "phase": phase,
+                "start": start,
+                "duration": time() - start,
+                "status": status,
+                "pid": os.getpid(),
+                **fields,
+            }
+        )
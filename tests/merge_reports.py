@@ -0,0 +1,80 @@
+import argparse
+import csv
+
+def merge_search_reports(shard_reports, merged_report):
+    # the shards number their candidates independently, so the candidates are
+    # renumbered by interleaving the shards, which is not the order a single
+    # search would have tried them in
+    rows = []
+    for shard, shard_report in enumerate(shard_reports):
+        with open(shard_report, newline='') as csvfile:
+            for row in csv.reader(csvfile):
+                rows.append((int(row[0]), shard, row))
+
+    with open(merged_report, "w") as report:
+        for (uid, (_, _, row)) in enumerate(sorted(rows, key=lambda r: (r[0], r[1]))):
+            fields = [str(uid), row[1], f'"{row[2]}"'] + row[3:]
+            report.write(",".join(fields) + "\n")
+
+def merge_distributions(shard_distributions, merged_distribution):
+    times = []
+    for shard_distribution in shard_distributions:
+        with open(shard_distribution, newline='') as csvfile:
+            times += [float(row["time"]) for row in csv.DictReader(csvfile)]
+
+    times = sorted(times)
+    with open(merged_distribution, "w") as distribution_file:
+        distribution_file.write(f"time,percent\n")
+        for (i, measured_time) in enumerate(times):
+            percent = (i + 1) / len(times)
+            distribution_file.write(f"{measured_time},{percent}\n")
+
+def merge_results(shard_results, merged_results):
+    # a sharded search is over once any of its shards succeeds, so the fastest
+    # shard gives the time and design of each repetition
+    fastest = {}
+    for shard_result in shard_results:
+        with open(shard_result) as results_file:
+            for line in results_file:
+                bench, rep, took, design = line.rstrip("\n").split(",", 3)
+                if (bench, rep) not in fastest or float(took) < fastest[(bench, rep)][0]:
+                    fastest[(bench, rep)] = (float(took), design)
+
+    with open(merged_results, "w") as results_file:
+        for ((bench, rep), (took, design)) in fastest.items():
+            results_file.write(f"{bench},{rep},{took},{design}\n")
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge the reports of a search sharded with tests.synthesize_crdt --shard.')
+    parser.add_argument('mode', choices=['synth', 'synth-unbounded'], help='synthesis mode')
+    parser.add_argument('benchmark', help='benchmark name')
+    parser.add_argument('--first', type=int, help='the number of structures each shard synthesized')
+    parser.add_argument('--repeat', type=int, default=1, help='number of repetitions')
+    parser.add_argument('--shards', type=int, required=True, help='number of shards')
+
+    args = parser.parse_args()
+
+    bench = args.benchmark
+    first_n = args.first
+    bounded_bench_str = "bounded-pruning" if args.mode == "synth" else "direct-unbounded"
+    shard_suffixes = [f"-shard_{i}_of_{args.shards}" for i in range(args.shards)]
+    # outputs that differ from those of a single run are named after the shards
+    merged_suffix = f"-shards_{args.shards}"
+
+    for rep in range(args.repeat):
+        report_file = f"search-{bench}-{rep}-{bounded_bench_str}-first_{first_n}"
+        merge_search_reports([f"{report_file}{suffix}.csv" for suffix in shard_suffixes], f"{report_file}{merged_suffix}.csv")
+        print(f"Merged {args.shards} shards into {report_file}{merged_suffix}.csv")
+
+    if first_n == None:
+        results_file = f"results-{bench}-{bounded_bench_str}"
+        merge_results([f"{results_file}{suffix}.csv" for suffix in shard_suffixes], f"{results_file}{merged_suffix}.csv")
+        print(f"Merged {args.shards} shards into {results_file}{merged_suffix}.csv")
+
+    if first_n != None:
+        distribution_file = f"benchmarks-{bench}-{bounded_bench_str}-first_{first_n}"
+        merge_distributions([f"{distribution_file}{suffix}-distribution.csv" for suffix in shard_suffixes], f"{distribution_file}-distribution.csv")
+        print(f"Merged {args.shards} shards into {distribution_file}-distribution.csv")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+import argparse
+import multiprocessing as mp
+from katara import telemetry
+from katara.cegis import CounterexampleBank
+from katara.result_cache import ResultCache
+from katara.search_broker import parse_address, run_worker
+from tests.synthesize_crdt import load_benchmark, use_race
+
+def main():
+    parser = argparse.ArgumentParser(description='Synthesize candidates handed out by a distributed structure search.')
+    parser.add_argument('address', help='HOST:PORT of the coordinator started with --serve')
+    parser.add_argument('--authkey', required=True, help='shared secret of the coordinator, as printed when it started')
+    parser.add_argument('--slots', type=int, default=max(mp.cpu_count() // 2, 1), help='number of candidates to synthesize at once')
+    parser.add_argument('--cache', help='directory to cache synthesis outcomes in across runs')
+    parser.add_argument('--telemetry', metavar='FILE', help='append a JSON record with the duration of every synthesis phase to FILE')
+    parser.add_argument('--counterexample-bank', metavar='DIR', help='directory to bank counterexamples in and replay them from')
+    parser.add_argument('--seed-counterexamples', action='store_true', help='also synthesize candidates against the banked counterexamples')
+    parser.add_argument('--race', nargs='+', metavar='BACKEND', help='race these backends on every synthesis problem, as with tests.synthesize_crdt')
+
+    args = parser.parse_args()
+
+    if args.telemetry:
+        telemetry.configure(args.telemetry)
+
+    if args.race:
+        use_race(args.race)
+
+    result_cache = ResultCache(args.cache) if args.cache else None
+    counterexample_bank = CounterexampleBank(args.counterexample_bank, seed=args.seed_counterexamples) if args.counterexample_bank else None
+    run_worker(parse_address(args.address), args.authkey.encode(), load_benchmark, args.slots, result_cache, counterexampleBank=counterexample_bank)
+
+if __name__ == "__main__":
+    main()
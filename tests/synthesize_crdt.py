@@ -1,9 +1,19 @@
 import argparse
 import contextlib
 import csv
+import glob
 from time import time
 from typing import List
-from katara.search_structures import search_crdt_structures
+from katara.candidate_scope import CandidateBudget
+from katara.cegis import CounterexampleBank
+from katara.concurrency import ConcurrencyController
+from katara import telemetry
+from katara.metrics import SearchMetrics
+from katara.result_cache import ResultCache
+from katara.search_broker import SearchBroker, parse_address
+from katara.search_checkpoint import SearchCheckpoint
+from katara.racing import race, synthesize_cvc5, with_list_bound
+from katara.search_structures import CostModel, SearchProblem, search_crdt_structures
 from metalift.analysis import CodeInfo
 from metalift.ir import *
 import katara.lattices as lat
@@ -262,21 +272,139 @@ def increasing_depth_structures(underlying, nonIdempotent):
             yield (base_depth, struct)
         base_depth += 1
 
+# the backend benchmarks are synthesized with, see use_race
+synthesis_backend = synthesize
+
+def use_race(specs):
+    """Race the backends described by `specs` on every synthesis problem, each
+    one of "cvc5", "rosette" or "rosette+N" (with lists bounded N longer)."""
+    global synthesis_backend
+    backends = []
+    for spec in specs:
+        if spec == "cvc5":
+            backends.append(synthesize_cvc5)
+        elif spec == "rosette":
+            backends.append(synthesize)
+        elif spec.startswith("rosette+"):
+            backends.append(with_list_bound(synthesize, int(spec[len("rosette+"):])))
+        else:
+            raise ValueError(f"unknown backend {spec}")
+    synthesis_backend = race(backends)
+
+def load_benchmark(bench):
+    bench_data = benchmarks[bench]
+
+    clock_augmented_order = bench_data["inOrder"]
+    if bench_data["opArgTypeHint"] and bench_data["opArgTypeHint"][-1] == ClockInt():
+        orig_order = clock_augmented_order
+        clock_augmented_order = lambda arg1, arg2: Ite(
+            Lt(arg1[-1], arg2[-1]),  # if clocks in order
+            BoolLit(True),
+            Ite(
+                Eq(arg1[-1], arg2[-1]), # if clocks concurrent
+                orig_order(arg1, arg2),
+                BoolLit(False), # clocks out of order
+            )
+        )
+
+    return SearchProblem(
+        initState,
+        grammarStateInvariant,
+        grammarSupportedCommand,
+        clock_augmented_order,
+        bench_data["opPrecondition"],
+        grammar,
+        grammarQuery,
+        grammarEquivalence,
+        targetLang,
+        synthesis_backend,
+        filename=f"tests/{bench_data['ll_name']}.ll",
+        fnNameBase="test",
+        loopsFile=f"tests/{bench_data['ll_name']}.loops",
+        cvcPath="cvc5",
+        stateTypeHint=bench_data["stateTypeHint"],
+        opArgTypeHint=bench_data["opArgTypeHint"],
+        queryArgTypeHint=bench_data["queryArgTypeHint"],
+        queryRetTypeHint=bench_data["queryRetTypeHint"],
+    )
+
 def main():
     parser = argparse.ArgumentParser(description='Synthesize CRDTs from sequential types.')
     parser.add_argument('mode', choices=['synth', 'synth-unbounded'], help='synthesis mode')
     parser.add_argument('benchmark', help='benchmark name or "all"')
     parser.add_argument('--fixed', action='store_true', help='use fixed lattice structure')
+    parser.add_argument('--depths', type=int, default=1, help='with --fixed, synthesize the structure at this many base depths at once and keep the shallowest design')
     parser.add_argument('--first', type=int, help='synthesize the first N structures')
     parser.add_argument('--repeat', type=int, default=1, help='number of repetitions')
+    parser.add_argument('--processes', action='store_true', help='synthesize candidates in a process pool')
+    parser.add_argument('--cache', help='directory to cache synthesis outcomes in across runs')
+    parser.add_argument('--resume', action='store_true', help='resume interrupted searches from their checkpoints')
+    parser.add_argument('--schedule', action='store_true', help='reorder candidates by a cost model fitted from earlier search reports')
+    parser.add_argument('--lookahead', type=int, default=32, help='number of upcoming candidates the scheduler reorders')
+    parser.add_argument('--time-budget', type=float, help='seconds a candidate may take before it is cancelled')
+    parser.add_argument('--memory-budget', type=int, help='megabytes of solver memory a candidate may use before it is cancelled')
+    parser.add_argument('--budget-growth', type=float, default=1.0, help='factor to scale the budgets by for every additional base depth')
+    parser.add_argument('--prefilter-workers', type=int, default=1, help='number of workers checking upcoming candidates for feasibility')
+    parser.add_argument('--keep-isomorphic', action='store_true', help='also try structures isomorphic to ones already enumerated')
+    parser.add_argument('--telemetry', metavar='FILE', help='append a JSON record with the duration of every synthesis phase to FILE')
+    parser.add_argument('--metrics-file', metavar='FILE', help='periodically write search metrics to FILE for the Prometheus node exporter textfile collector')
+    parser.add_argument('--metrics-port', type=int, help='serve search metrics for Prometheus on localhost at this port')
+    parser.add_argument('--adaptive', action='store_true', help='adapt the number of candidates synthesized at once to the load of the host')
+    parser.add_argument('--min-in-flight', type=int, default=1, help='lower bound on the number of candidates synthesized at once with --adaptive')
+    parser.add_argument('--max-in-flight', type=int, default=mp.cpu_count(), help='upper bound on the number of candidates synthesized at once with --adaptive')
+    parser.add_argument('--portfolio', action='store_true', help='try the escalations of a candidate that fails to verify concurrently instead of one after the other')
+    parser.add_argument('--cegis', type=int, default=0, metavar='N', help='re-synthesize a design that fails to verify with its counterexample up to N times before increasing bounds')
+    parser.add_argument('--counterexample-bank', metavar='DIR', help='directory to bank the counterexamples of failed verifications in, and to replay them against later candidates from')
+    parser.add_argument('--seed-counterexamples', action='store_true', help='also synthesize later candidates against the banked counterexamples')
+    parser.add_argument('--race', nargs='+', metavar='BACKEND', help='race these backends on every synthesis problem: cvc5, rosette or rosette+N (with lists bounded N longer)')
+    parser.add_argument('--shard', metavar='I/N', help='only try every N-th candidate, starting from the I-th (counting from 0)')
+    parser.add_argument('--serve', metavar='HOST:PORT', help='hand out candidates to workers started with tests.search_worker instead of synthesizing them locally')
+    parser.add_argument('--authkey', help='shared secret workers must present with --serve (a random one is generated and printed if not given)')
 
     args = parser.parse_args()
 
+    if args.telemetry:
+        telemetry.configure(args.telemetry)
+
+    if args.race:
+        use_race(args.race)
+
     mode = args.mode
     bench = args.benchmark
     fixed_structure = args.fixed
     first_n = args.first
     reps = args.repeat
+    use_processes = args.processes
+    result_cache = ResultCache(args.cache) if args.cache else None
+    counterexample_bank = CounterexampleBank(args.counterexample_bank, seed=args.seed_counterexamples) if args.counterexample_bank else None
+    resume = args.resume
+    schedule = args.schedule
+    prune_isomorphic = not args.keep_isomorphic
+    shard = None
+    shard_suffix = ""
+    if args.shard:
+        shard = tuple(int(part) for part in args.shard.split("/"))
+        shard_suffix = f"-shard_{shard[0]}_of_{shard[1]}"
+    budget = None
+    if args.time_budget is not None or args.memory_budget is not None:
+        budget = CandidateBudget(
+            args.time_budget,
+            args.memory_budget * 1024 * 1024 if args.memory_budget is not None else None,
+            args.budget_growth,
+        )
+
+    metrics = None
+    if args.metrics_file or args.metrics_port:
+        metrics = SearchMetrics(args.metrics_file, args.metrics_port, labels={"benchmark": bench})
+        metrics.start()
+
+    broker = None
+    if args.serve:
+        broker = SearchBroker(parse_address(args.serve), args.authkey.encode() if args.authkey else None)
+        broker.start()
+        print(f"Serving candidates at {args.serve}")
+        if not args.authkey:
+            print(f"Workers must connect with --authkey {broker.authkey.decode()}")
 
     if bench == "all":
         benches = list(benchmarks.keys())
@@ -289,21 +417,18 @@ def main():
 
     bounded_bench_str = "bounded-pruning" if useOpList else "direct-unbounded"
 
-    bench_file = open(f"results-{bench}-{bounded_bench_str}.csv", "w") if first_n == None else contextlib.nullcontext()
+    bench_file = open(f"results-{bench}-{bounded_bench_str}{shard_suffix}.csv", "w") if first_n == None else contextlib.nullcontext()
     with bench_file as report:
         for bench in benches:
             bench_data = benchmarks[bench]
 
-            filename = f"tests/{bench_data['ll_name']}.ll"
-            fnNameBase = "test"
-            loopsFile = f"tests/{bench_data['ll_name']}.loops"
-            cvcPath = "cvc5"
+            problem = load_benchmark(bench)
 
             nonIdempotent = "nonIdempotent" in bench_data and bench_data["nonIdempotent"]
 
             for rep in range(reps):
                 structure_generator = increasing_depth_structures(
-                    (lambda base_depth: lat.gen_structures(base_depth))
+                    (lambda base_depth: lat.gen_structures(base_depth, prune_isomorphic))
                     if not fixed_structure
                     else
                     (lambda _: [bench_data["fixedLatticeType"]]),
@@ -311,42 +436,54 @@ def main():
                 )
 
                 start_time = time()
-                report_file = f"search-{bench}-{rep}-{bounded_bench_str}-first_{first_n}.csv"
-
-                clock_augmented_order = bench_data["inOrder"]
-                if bench_data["opArgTypeHint"] and bench_data["opArgTypeHint"][-1] == ClockInt():
-                    orig_order = clock_augmented_order
-                    clock_augmented_order = lambda arg1, arg2: Ite(
-                        Lt(arg1[-1], arg2[-1]),  # if clocks in order
-                        BoolLit(True),
-                        Ite(
-                            Eq(arg1[-1], arg2[-1]), # if clocks concurrent
-                            orig_order(arg1, arg2),
-                            BoolLit(False), # clocks out of order
-                        )
-                    )
+                report_file = f"search-{bench}-{rep}-{bounded_bench_str}-first_{first_n}{shard_suffix}.csv"
+                checkpoint_file = f"{report_file}.checkpoint"
+                checkpoint = SearchCheckpoint.load(checkpoint_file) if resume else SearchCheckpoint(checkpoint_file)
+
+                cost_model = None
+                if schedule:
+                    history = [f for f in glob.glob(f"search-{bench}-*.csv") if f != report_file]
+                    cost_model = CostModel.fit(history)
 
                 (result_type, result_fns) = search_crdt_structures(
-                    initState,
-                    grammarStateInvariant,
-                    grammarSupportedCommand,
-                    clock_augmented_order,
-                    bench_data["opPrecondition"],
-                    grammar,
-                    grammarQuery,
-                    grammarEquivalence,
-                    targetLang,
-                    synthesize,
-                    filename, fnNameBase, loopsFile, cvcPath, useOpList,
+                    problem.initState,
+                    problem.grammarStateInvariant,
+                    problem.grammarSupportedCommand,
+                    problem.inOrder,
+                    problem.opPrecondition,
+                    problem.grammar,
+                    problem.grammarQuery,
+                    problem.grammarEquivalence,
+                    problem.targetLang,
+                    problem.synthesize,
+                    problem.filename, problem.fnNameBase, problem.loopsFile, problem.cvcPath, useOpList,
                     structure_generator,
                     reportFile=report_file,
-                    stateTypeHint=bench_data["stateTypeHint"],
-                    opArgTypeHint=bench_data["opArgTypeHint"],
-                    queryArgTypeHint=bench_data["queryArgTypeHint"],
-                    queryRetTypeHint=bench_data["queryRetTypeHint"],
-                    maxThreads=1 if fixed_structure else mp.cpu_count(),
+                    stateTypeHint=problem.stateTypeHint,
+                    opArgTypeHint=problem.opArgTypeHint,
+                    queryArgTypeHint=problem.queryArgTypeHint,
+                    queryRetTypeHint=problem.queryRetTypeHint,
+                    # at most maxThreads // 2 candidates run at once
+                    maxThreads=(2 * args.depths if args.depths > 1 else 1) if fixed_structure else mp.cpu_count(),
                     upToUid=first_n,
                     exitFirstSuccess=first_n == None,
+                    useProcesses=use_processes,
+                    benchmark=bench,
+                    problemLoader=load_benchmark,
+                    resultCache=result_cache,
+                    checkpoint=checkpoint,
+                    costModel=cost_model,
+                    lookahead=args.lookahead,
+                    budget=budget,
+                    prefilterWorkers=args.prefilter_workers,
+                    broker=broker,
+                    shard=shard,
+                    metrics=metrics,
+                    concurrency=ConcurrencyController(args.min_in_flight, args.max_in_flight, initial=mp.cpu_count() // 2) if args.adaptive and not fixed_structure else None,
+                    portfolio=args.portfolio,
+                    preferShallowest=fixed_structure,
+                    cegisRounds=args.cegis,
+                    counterexampleBank=counterexample_bank,
                 )
                 end_time = time()
 
@@ -359,11 +496,17 @@ def main():
                     with open(report_file, newline='') as csvfile:
                         report_reader = csv.reader(csvfile)
                         times = sorted([float(row[1]) for row in report_reader])
-                        with open(f"benchmarks-{bench}-{bounded_bench_str}-first_{first_n}-distribution.csv", "w") as distribution_file:
+                        with open(f"benchmarks-{bench}-{bounded_bench_str}-first_{first_n}{shard_suffix}-distribution.csv", "w") as distribution_file:
                             distribution_file.write(f"time,percent\n")
                             for (i, measured_time) in enumerate(times):
                                 percent = (i + 1) / len(times)
                                 distribution_file.write(f"{measured_time},{percent}\n")
 
+    if broker is not None:
+        broker.shutdown()
+
+    if metrics is not None:
+        metrics.stop()
+
 if __name__ == "__main__":
     main()
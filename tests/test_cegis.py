@@ -0,0 +1,73 @@
+from metalift.ir import Add, Call, Eq, Implies, Int, IntLit, Lambda, MapT, Var
+
+from katara.cegis import instantiate, uses_function_arguments
+
+# the VC of a counter whose next state should add the argument, shaped like
+# those built by synthesize_crdt: the state after the operation is only
+# constrained to be the result of the synthesized function
+start = Var("synth_start_state", Int())
+arg = Var("first_op_arg", Int())
+after = Var("synth_after_op", Int())
+vc = Implies(
+    Eq(after, Call("next_state", Int(), start, arg)),
+    Eq(after, Add(start, arg)),
+)
+
+# a model CVC5 gives for the rejected design next_state(s, a) = s, which
+# binds every variable of the VC
+assignment = {"synth_start_state": IntLit(1), "first_op_arg": IntLit(2), "synth_after_op": IntLit(1)}
+
+def evaluate(e, design, values):
+    if isinstance(e, Var):
+        return values[e.name()]
+    elif isinstance(e, IntLit):
+        return e.args[0]
+    elif isinstance(e, Call):
+        return design(*[evaluate(a, design, values) for a in e.args[1:]])
+    args = [evaluate(a, design, values) for a in e.args]
+    if isinstance(e, Add):
+        return args[0] + args[1]
+    elif isinstance(e, Eq):
+        return args[0] == args[1]
+    elif isinstance(e, Implies):
+        return not args[0] or args[1]
+    raise NotImplementedError(type(e).__name__)
+
+def excludes(instance, design):
+    # whether the design violates the instance for some value of the
+    # variables left free
+    return not all(evaluate(instance, design, {"synth_after_op": v}) for v in range(-10, 10))
+
+rejected = lambda s, a: s
+other_wrong = lambda s, a: a
+correct = lambda s, a: s + a
+
+def test_instantiate():
+    instance = instantiate(vc, assignment, {start, arg})
+    assert excludes(instance, rejected)
+    assert excludes(instance, other_wrong)
+    assert not excludes(instance, correct)
+
+def test_derived_variables_stay_free():
+    # fixing the state after the operation to the value of the rejected design
+    # makes the instance hold for any other design
+    trivial = vc.rewrite(assignment)
+    assert not excludes(trivial, other_wrong)
+    assert instantiate(vc, assignment, {start, arg, after}) == trivial
+
+def test_uses_function_arguments():
+    assert not uses_function_arguments([vc])
+
+    # the merge of a map lattice passes the merge of its values as a function
+    a = Var("a", MapT(Int(), Int()))
+    b = Var("b", MapT(Int(), Int()))
+    v_a = Var("v_a", Int())
+    v_b = Var("v_b", Int())
+    merge = Call("map-union", MapT(Int(), Int()), a, b, Lambda(Int(), Add(v_a, v_b), v_a, v_b))
+    assert uses_function_arguments([vc, Implies(Eq(a, merge), Eq(b, merge))])
+
+if __name__ == "__main__":
+    test_instantiate()
+    test_derived_variables_stay_free()
+    test_uses_function_arguments()
+    print("All CEGIS tests passed")
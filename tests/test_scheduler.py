@@ -0,0 +1,127 @@
+import os
+import tempfile
+import time
+
+from katara import search_structures
+from katara.concurrency import ConcurrencyController
+from katara.search_checkpoint import SearchCheckpoint
+from katara.search_structures import CandidateScheduler, CostModel, structure_features
+
+# structures are given as printed in search reports, the model only looks at
+# their text so no solver or LLVM analysis is needed
+SIMPLE = "[MaxInt(Int)]"
+PRODUCT = "[LexicalProduct(MaxInt(Int), OrBool)]"
+MAP = "[Map(OpaqueInt, MaxInt(Int))]"
+
+def write_report(path):
+    rows = []
+    for i in range(4):
+        rows.append((SIMPLE, 1.0 + i * 0.1, True, 1))
+        rows.append((PRODUCT, 10.0 + i, i % 2 == 0, 1))
+        rows.append((MAP, 100.0 + i * 10, False, 2))
+    with open(path, "w") as f:
+        for uid, (structure, took, success, base_depth) in enumerate(rows):
+            f.write(f'{uid},{took},"{structure}",1,{success},{base_depth},{"success" if success else "failure"}\n')
+
+def fit_model():
+    with tempfile.TemporaryDirectory() as directory:
+        report = os.path.join(directory, "search-test.csv")
+        write_report(report)
+        return CostModel.fit([report])
+
+def test_fit():
+    model = fit_model()
+    simple = structure_features(SIMPLE, 1)
+    product = structure_features(PRODUCT, 1)
+    map = structure_features(MAP, 2)
+
+    assert model.expected_time(simple) < model.expected_time(product) < model.expected_time(map)
+    assert model.success_probability(simple) > model.success_probability(product) > model.success_probability(map)
+    # unseen structures fall back to the overall success rate
+    assert abs(model.success_probability(structure_features("[Set(Int)]", 3)) - model.prior) < 1e-9
+
+def test_dispatch_order():
+    model = fit_model()
+    stream = [(2, MAP), (1, PRODUCT), (1, SIMPLE), (2, MAP), (1, SIMPLE)]
+
+    # the most promising candidates of the window go first, ties keep the
+    # order of the stream
+    assert list(CandidateScheduler(iter(stream), model, 8)) == [
+        (1, SIMPLE), (1, SIMPLE), (1, PRODUCT), (2, MAP), (2, MAP)
+    ]
+
+    # candidates are only reordered within the window
+    assert list(CandidateScheduler(iter(stream), model, 2)) == [
+        (1, PRODUCT), (1, SIMPLE), (2, MAP), (1, SIMPLE), (2, MAP)
+    ]
+    assert list(CandidateScheduler(iter(stream), model, 1)) == stream
+
+def test_empty_report():
+    with tempfile.TemporaryDirectory() as directory:
+        report = os.path.join(directory, "search-empty.csv")
+        open(report, "w").close()
+        model = CostModel.fit([report])
+    stream = [(1, MAP), (1, SIMPLE)]
+    assert list(CandidateScheduler(iter(stream), model, 8)) == stream
+
+def fake_synthesize_crdt_e2e(queue, structure, *args, **kwargs):
+    baseDepth, uid = args[15], args[20]
+    time.sleep(0.01)
+    queue.put((uid, structure, baseDepth, None, "failure", {}))
+
+def test_concurrency_grows():
+    # an idle host, so that only the slots in use decide whether to grow
+    controller = ConcurrencyController(1, 4, initial=2, interval=0.02, lowLoad=float("inf"), highLoad=float("inf"), memoryReserve=0)
+    candidates = iter([(1, [SIMPLE])] * 40)
+
+    original = (search_structures.synthesize_crdt_e2e, search_structures.structure_is_feasible, search_structures.analysis_cache.warm)
+    search_structures.synthesize_crdt_e2e = fake_synthesize_crdt_e2e
+    search_structures.structure_is_feasible = lambda *args: True
+    search_structures.analysis_cache.warm = lambda *args: None
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            search_structures.search_crdt_structures(
+                *[None] * 10, "test.ll", "test", "test.loops", "cvc5", False, candidates,
+                os.path.join(directory, "search-test.csv"), exitFirstSuccess=False, concurrency=controller
+            )
+    finally:
+        (search_structures.synthesize_crdt_e2e, search_structures.structure_is_feasible, search_structures.analysis_cache.warm) = original
+
+    assert controller.current == 4
+
+def test_resume_replaces_rows():
+    original = (search_structures.synthesize_crdt_e2e, search_structures.structure_is_feasible, search_structures.analysis_cache.warm)
+    search_structures.synthesize_crdt_e2e = fake_synthesize_crdt_e2e
+    search_structures.structure_is_feasible = lambda *args: True
+    search_structures.analysis_cache.warm = lambda *args: None
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            report = os.path.join(directory, "search-test.csv")
+            # killed with #1 in flight and #3 reported after the last save
+            with open(report, "w") as f:
+                for uid in [0, 2, 3]:
+                    f.write(f'{uid},1.0,"{[SIMPLE]}",1,False,1,failure,0\n')
+            checkpoint = SearchCheckpoint(os.path.join(directory, "search-test.checkpoint"))
+            checkpoint.position = 3
+            checkpoint.next_uid = 3
+            checkpoint.in_flight = {1: (1, [SIMPLE])}
+            checkpoint.save()
+
+            search_structures.search_crdt_structures(
+                *[None] * 10, "test.ll", "test", "test.loops", "cvc5", False, iter([(1, [SIMPLE])] * 5),
+                report, exitFirstSuccess=False, checkpoint=SearchCheckpoint.load(checkpoint.path)
+            )
+            with open(report) as f:
+                uids = sorted(int(row.split(",")[0]) for row in f)
+    finally:
+        (search_structures.synthesize_crdt_e2e, search_structures.structure_is_feasible, search_structures.analysis_cache.warm) = original
+
+    assert uids == [0, 1, 2, 3, 4]
+
+if __name__ == "__main__":
+    test_fit()
+    test_dispatch_order()
+    test_empty_report()
+    test_concurrency_grows()
+    test_resume_replaces_rows()
+    print("All scheduler tests passed")